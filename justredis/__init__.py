@@ -1,5 +1,6 @@
 from .sync.redis import Redis
 from .decoder import Error
+from .encoder import register_encoder, unregister_encoder
 
 # TODO (misc) keep this in sync
 from .errors import *
@@ -28,4 +29,4 @@ except AttributeError as e:
             raise Exception(e.args[0])
 
 
-__all__ = "AsyncRedis", "Redis", "RedisError", "CommunicationError", "ConnectionPoolError", "ProtocolError", "PipelinedExceptions", "Error"
+__all__ = "AsyncRedis", "Redis", "RedisError", "CommunicationError", "ConnectionPoolError", "ProtocolError", "PipelinedExceptions", "Error", "register_encoder", "unregister_encoder"
@@ -0,0 +1,286 @@
+# A static command table in the same layout as the COMMAND reply: name, arity, flags, first key, last key, step
+# It covers the common commands, so a cluster can route them without fetching the table from the server first
+
+
+def _commands(flags, first, last, step, *commands):
+    return [[name.lower(), arity, flags, first, last, step] for name, arity in commands]
+
+
+_readonly = (b"readonly",)
+_write = (b"write",)
+_movablekeys_readonly = (b"readonly", b"movablekeys")
+_movablekeys_write = (b"write", b"movablekeys")
+_keyless = ()
+# Neither readonly nor write, it must run on the master which runs the MULTI / EXEC after it
+_transaction = (b"noscript", b"fast")
+
+static_commands = {}
+for _info in (
+    # Single key commands
+    _commands(
+        _readonly,
+        1,
+        1,
+        1,
+        (b"GET", 2),
+        (b"STRLEN", 2),
+        (b"GETRANGE", 4),
+        (b"SUBSTR", 4),
+        (b"GETBIT", 3),
+        (b"BITCOUNT", -2),
+        (b"BITPOS", -3),
+        (b"BITFIELD_RO", -2),
+        (b"TTL", 2),
+        (b"PTTL", 2),
+        (b"TYPE", 2),
+        (b"DUMP", 2),
+        (b"SORT_RO", -2),
+        (b"HGET", 3),
+        (b"HMGET", -3),
+        (b"HLEN", 2),
+        (b"HSTRLEN", 3),
+        (b"HEXISTS", 3),
+        (b"HKEYS", 2),
+        (b"HVALS", 2),
+        (b"HGETALL", 2),
+        (b"HSCAN", -3),
+        (b"HRANDFIELD", -2),
+        (b"LLEN", 2),
+        (b"LINDEX", 3),
+        (b"LRANGE", 4),
+        (b"LPOS", -3),
+        (b"SISMEMBER", 3),
+        (b"SMISMEMBER", -3),
+        (b"SCARD", 2),
+        (b"SRANDMEMBER", -2),
+        (b"SMEMBERS", 2),
+        (b"SSCAN", -3),
+        (b"ZRANGE", -4),
+        (b"ZRANGEBYSCORE", -4),
+        (b"ZREVRANGEBYSCORE", -4),
+        (b"ZRANGEBYLEX", -4),
+        (b"ZREVRANGEBYLEX", -4),
+        (b"ZREVRANGE", -4),
+        (b"ZCOUNT", 4),
+        (b"ZLEXCOUNT", 4),
+        (b"ZCARD", 2),
+        (b"ZSCORE", 3),
+        (b"ZMSCORE", -3),
+        (b"ZRANK", -3),
+        (b"ZREVRANK", -3),
+        (b"ZSCAN", -3),
+        (b"ZRANDMEMBER", -2),
+        (b"XRANGE", -4),
+        (b"XREVRANGE", -4),
+        (b"XLEN", 2),
+        (b"XPENDING", -3),
+        (b"GEODIST", -4),
+        (b"GEOHASH", -2),
+        (b"GEOPOS", -2),
+        (b"GEORADIUS_RO", -6),
+        (b"GEORADIUSBYMEMBER_RO", -5),
+        (b"GEOSEARCH", -7),
+    ),
+    _commands(
+        _write,
+        1,
+        1,
+        1,
+        (b"SET", -3),
+        (b"SETNX", 3),
+        (b"SETEX", 4),
+        (b"PSETEX", 4),
+        (b"GETSET", 3),
+        (b"GETDEL", 2),
+        (b"GETEX", -2),
+        (b"APPEND", 3),
+        (b"INCR", 2),
+        (b"DECR", 2),
+        (b"INCRBY", 3),
+        (b"DECRBY", 3),
+        (b"INCRBYFLOAT", 3),
+        (b"SETRANGE", 4),
+        (b"SETBIT", 4),
+        (b"BITFIELD", -2),
+        (b"EXPIRE", -3),
+        (b"PEXPIRE", -3),
+        (b"EXPIREAT", -3),
+        (b"PEXPIREAT", -3),
+        (b"PERSIST", 2),
+        (b"MOVE", 3),
+        (b"RESTORE", -4),
+        (b"HSET", -4),
+        (b"HSETNX", 4),
+        (b"HMSET", -4),
+        (b"HDEL", -3),
+        (b"HINCRBY", 4),
+        (b"HINCRBYFLOAT", 4),
+        (b"LPUSH", -3),
+        (b"RPUSH", -3),
+        (b"LPUSHX", -3),
+        (b"RPUSHX", -3),
+        (b"LINSERT", 5),
+        (b"LPOP", -2),
+        (b"RPOP", -2),
+        (b"LSET", 4),
+        (b"LTRIM", 4),
+        (b"LREM", 4),
+        (b"SADD", -3),
+        (b"SREM", -3),
+        (b"SPOP", -2),
+        (b"ZADD", -4),
+        (b"ZINCRBY", 4),
+        (b"ZREM", -3),
+        (b"ZREMRANGEBYSCORE", 4),
+        (b"ZREMRANGEBYRANK", 4),
+        (b"ZREMRANGEBYLEX", 4),
+        (b"ZPOPMIN", -2),
+        (b"ZPOPMAX", -2),
+        (b"XADD", -5),
+        (b"XDEL", -3),
+        (b"XTRIM", -4),
+        (b"XACK", -4),
+        (b"XCLAIM", -6),
+        (b"XAUTOCLAIM", -6),
+        (b"XSETID", -3),
+        (b"PFADD", -2),
+        (b"GEOADD", -5),
+    ),
+    # Multiple keys commands
+    _commands(_readonly, 1, -1, 1, (b"MGET", -2), (b"EXISTS", -2), (b"TOUCH", -2), (b"SINTER", -2), (b"SUNION", -2), (b"SDIFF", -2), (b"PFCOUNT", -2)),
+    _commands(_transaction, 1, -1, 1, (b"WATCH", -2)),
+    _commands(_write, 1, -1, 1, (b"DEL", -2), (b"UNLINK", -2), (b"SINTERSTORE", -3), (b"SUNIONSTORE", -3), (b"SDIFFSTORE", -3), (b"PFMERGE", -2)),
+    _commands(_write, 1, -1, 2, (b"MSET", -3), (b"MSETNX", -3)),
+    _commands(_write, 1, 2, 1, (b"RENAME", 3), (b"RENAMENX", 3), (b"COPY", -3), (b"RPOPLPUSH", 3), (b"LMOVE", 5), (b"BRPOPLPUSH", 4), (b"BLMOVE", 6), (b"SMOVE", 4), (b"ZRANGESTORE", -5), (b"GEOSEARCHSTORE", -8)),
+    _commands(_write, 1, -2, 1, (b"BLPOP", -3), (b"BRPOP", -3), (b"BZPOPMIN", -3), (b"BZPOPMAX", -3)),
+    _commands(_write, 2, -1, 1, (b"BITOP", -4)),
+    _commands(_readonly, 2, 2, 1, (b"OBJECT", -2), (b"XINFO", -2)),
+    _commands(_write, 2, 2, 1, (b"XGROUP", -2)),
+    # Commands which have keys in a position which depends on their arguments
+    _commands(_movablekeys_write, 1, 1, 1, (b"SORT", -2), (b"GEORADIUS", -6), (b"GEORADIUSBYMEMBER", -5)),
+    _commands(_movablekeys_write, 0, 0, 0, (b"EVAL", -3), (b"EVALSHA", -3), (b"FCALL", -3), (b"ZUNIONSTORE", -4), (b"ZINTERSTORE", -4), (b"ZDIFFSTORE", -4), (b"LMPOP", -4), (b"BLMPOP", -5), (b"ZMPOP", -4), (b"BZMPOP", -5), (b"XREADGROUP", -7), (b"MIGRATE", -6)),
+    _commands(_movablekeys_readonly, 0, 0, 0, (b"EVAL_RO", -3), (b"EVALSHA_RO", -3), (b"FCALL_RO", -3), (b"ZUNION", -3), (b"ZINTER", -3), (b"ZDIFF", -3), (b"ZINTERCARD", -3), (b"SINTERCARD", -3), (b"XREAD", -4)),
+    # Commands without keys
+    _commands(
+        _keyless,
+        0,
+        0,
+        0,
+        (b"PING", -1),
+        (b"ECHO", 2),
+        (b"INFO", -1),
+        (b"SELECT", 2),
+        (b"AUTH", -2),
+        (b"HELLO", -1),
+        (b"CLIENT", -2),
+        (b"CONFIG", -2),
+        (b"CLUSTER", -2),
+        (b"COMMAND", -1),
+        (b"TIME", 1),
+        (b"DBSIZE", 1),
+        (b"KEYS", 2),
+        (b"SCAN", -2),
+        (b"RANDOMKEY", 1),
+        (b"FLUSHDB", -1),
+        (b"FLUSHALL", -1),
+        (b"PUBLISH", 3),
+        (b"PUBSUB", -2),
+        (b"SCRIPT", -2),
+        (b"FUNCTION", -2),
+        (b"MULTI", 1),
+        (b"EXEC", 1),
+        (b"DISCARD", 1),
+        (b"UNWATCH", 1),
+        (b"READONLY", 1),
+        (b"READWRITE", 1),
+        (b"WAIT", 3),
+        (b"SAVE", 1),
+        (b"BGSAVE", -1),
+        (b"LASTSAVE", 1),
+        (b"ROLE", 1),
+        (b"SLOWLOG", -2),
+        (b"LATENCY", -2),
+        (b"MEMORY", -2),
+        (b"DEBUG", -2),
+    ),
+):
+    for _command in _info:
+        static_commands[_command[0].upper()] = _command
+
+
+def _key_after_numkeys(position):
+    def first_key(cmd):
+        try:
+            numkeys = int(cmd[position])
+        except (IndexError, ValueError, TypeError):
+            return None
+        if numkeys < 1 or len(cmd) <= position + 1:
+            return None
+        return cmd[position + 1]
+
+    return first_key
+
+
+def _key_at(position):
+    def first_key(cmd):
+        if len(cmd) <= position:
+            return None
+        return cmd[position]
+
+    return first_key
+
+
+def _token_index(cmd, token, start):
+    for index in range(start, len(cmd)):
+        arg = cmd[index]
+        if isinstance(arg, str):
+            arg = arg.encode()
+        if isinstance(arg, (bytes, bytearray)) and arg.upper() == token:
+            return index
+    return None
+
+
+def _key_after_streams(cmd):
+    index = _token_index(cmd, b"STREAMS", 1)
+    if index is None or len(cmd) <= index + 1:
+        return None
+    return cmd[index + 1]
+
+
+def _migrate_key(cmd):
+    if len(cmd) > 3 and cmd[3] not in (b"", ""):
+        return cmd[3]
+    index = _token_index(cmd, b"KEYS", 6)
+    if index is None or len(cmd) <= index + 1:
+        return None
+    return cmd[index + 1]
+
+
+# Extracts the first key of a command (the one used for routing) client side, for commands with a first key index of 0 in the command table
+movable_keys = {
+    b"EVAL": _key_after_numkeys(2),
+    b"EVALSHA": _key_after_numkeys(2),
+    b"EVAL_RO": _key_after_numkeys(2),
+    b"EVALSHA_RO": _key_after_numkeys(2),
+    b"FCALL": _key_after_numkeys(2),
+    b"FCALL_RO": _key_after_numkeys(2),
+    b"ZUNIONSTORE": _key_at(1),
+    b"ZINTERSTORE": _key_at(1),
+    b"ZDIFFSTORE": _key_at(1),
+    b"ZUNION": _key_after_numkeys(1),
+    b"ZINTER": _key_after_numkeys(1),
+    b"ZDIFF": _key_after_numkeys(1),
+    b"ZINTERCARD": _key_after_numkeys(1),
+    b"SINTERCARD": _key_after_numkeys(1),
+    b"LMPOP": _key_after_numkeys(1),
+    b"ZMPOP": _key_after_numkeys(1),
+    b"BLMPOP": _key_after_numkeys(2),
+    b"BZMPOP": _key_after_numkeys(2),
+    b"XREAD": _key_after_streams,
+    b"XREADGROUP": _key_after_streams,
+    b"SORT": _key_at(1),
+    b"SORT_RO": _key_at(1),
+    b"GEORADIUS": _key_at(1),
+    b"GEORADIUSBYMEMBER": _key_at(1),
+    b"MIGRATE": _migrate_key,
+}
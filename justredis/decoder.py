@@ -1,45 +1,56 @@
 from collections import OrderedDict
+import sys
+
+try:
+    import hiredis
+except ImportError:
+    hiredis = None
 
 from .errors import ProtocolError
 
 
 # TODO (misc) We can add helpful error messages on which part the parsing failed, should we do that ?
 # TODO (misc) Should we make ProtocolError the catch all chain ?
-# TODO (misc) There is allot of code duplication here, we can merge most of it.
+
+
+# Below this size, slicing the bytearray is cheaper than creating a memoryview into it
+zero_copy_size = 2 ** 15
 
 
 # Python 2 bytearray implementation is less efficient, luckily it's EOL
+# Consumed data is tracked with a read offset and is only removed from the front of the bytearray when new data is fed (or when all of it was consumed), instead of on every token.
 class Buffer:
     def __init__(self):
         self._buffer = bytearray()
+        self._offset = 0
 
     def append(self, data):
+        if self._offset:
+            del self._buffer[: self._offset]
+            self._offset = 0
         self._buffer += data
 
-    def __len__(self):
-        return len(self._buffer)
-
-    def skip_if_startswith(self, data):
-        if self._buffer.startswith(data):
-            del self._buffer[: len(data)]
-            return True
-        return False
+    def compact(self):
+        if self._offset and self._offset == len(self._buffer):
+            self._buffer.clear()
+            self._offset = 0
 
-    def takeline(self):
-        idx = self._buffer.find(b"\r\n")
-        if idx == -1:
-            return None
-        ret = self._buffer[:idx]
-        del self._buffer[: idx + 2]
-        return ret
-
-    def take(self, nbytes):
-        ret = self._buffer[:nbytes]
-        del self._buffer[:nbytes]
-        return ret
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    # Large data is handed to the decoder as a memoryview, so it's copied only once (the view is released before the buffer can be resized)
+    def take(self, nbytes, decoder=bytes):
+        offset = self._offset
+        end = offset + nbytes
+        self._offset = end
+        if nbytes < zero_copy_size:
+            return decoder(self._buffer[offset:end])
+        with memoryview(self._buffer) as view:
+            with view[offset:end] as data:
+                return decoder(data)
 
     def skip(self, nbytes):
-        del self._buffer[:nbytes]
+        self._offset += nbytes
 
 
 class NeedMoreData:
@@ -107,361 +118,501 @@ class Push(Result):
 need_more_data = NeedMoreData()
 
 
+def decode_error(x):
+    return str(x, "utf-8", "replace")
+
+
 def parse_decoding(decoding):
     if decoding is None:
         return bytes
     elif isinstance(decoding, str):
-        return lambda x, decoding=decoding: x.decode(encoding=decoding)
+        return lambda x, decoding=decoding: str(x, encoding=decoding)
     elif isinstance(decoding, (tuple, list)):
-        return lambda x, decoding=decoding: x.decode(*decoding)
+        return lambda x, decoding=decoding: str(x, *decoding)
     elif isinstance(decoding, dict):
-        return lambda x, decoding=decoding: x.decode(**decoding)
+        return lambda x, decoding=decoding: str(x, **decoding)
     else:
         raise ValueError("Invalid decoding: %r" % decoding)
 
 
+# Returned by the parsers when they consumed a token which is not a value by itself (such as the start or end of an aggregate)
+class NoValue:
+    pass
+
+
+no_value = NoValue()
+
+
+# Since Python 3.7 a regular dict keeps the insertion order
+ordered_dict = dict if sys.version_info >= (3, 7) else OrderedDict
+
+
+# An aggregate that is being parsed, the elements are written directly into the final result
+class Aggregate:
+    __slots__ = "result_type", "length", "count", "data", "attr"
+
+    def __init__(self, result_type, length, attr):
+        self.result_type = result_type
+        self.length = length
+        self.count = 0
+        self.attr = attr
+
+
+class ArrayAggregate(Aggregate):
+    __slots__ = ()
+
+    def __init__(self, result_type, length, attr):
+        super(ArrayAggregate, self).__init__(result_type, length, attr)
+        # Streamed arrays have no length up front
+        self.data = [] if length is None else [None] * length
+
+    def add(self, msg):
+        if self.length is None:
+            self.data.append(msg)
+        else:
+            self.data[self.count] = msg
+        self.count += 1
+        return self.count == self.length
+
+
+class MapAggregate(Aggregate):
+    __slots__ = ("key",)
+
+    def __init__(self, result_type, length, attr):
+        super(MapAggregate, self).__init__(result_type, length, attr)
+        self.data = ordered_dict()
+        self.key = None
+
+    def add(self, msg):
+        if self.count & 1:
+            self.data[self.key] = msg
+        else:
+            # TODO (misc) is this the best way to deal with msg ?
+            self.key = bytes(msg) if msg.__hash__ is None else msg
+        self.count += 1
+        return self.count == self.length
+
+
+class SetAggregate(Aggregate):
+    __slots__ = ()
+
+    def __init__(self, result_type, length, attr):
+        super(SetAggregate, self).__init__(result_type, length, attr)
+        self.data = set()
+
+    def add(self, msg):
+        self.data.add(msg)
+        self.count += 1
+        return self.count == self.length
+
+
+# The start of a reply that is read as a stream, instead of being parsed completely
+class StreamHeader:
+    __slots__ = "result_type", "length"
+
+    def __init__(self, result_type, length):
+        self.result_type = result_type
+        self.length = length
+
+
+def build_dispatch_table(parsers, default):
+    table = [default] * 256
+    for prefix, parser in parsers.items():
+        table[ord(prefix)] = parser
+    return tuple(table)
+
+
+# Aggregate types being parsed are kept as a stack of Aggregate objects.
+# Every parser gets the location of the first line of the token in the buffer (without the type byte and \r\n), and either consumes the token or leaves the buffer as is and returns need_more_data.
 class RedisRespDecoder:
     # TODO (misc) maybe add decoder, and push_decoder ?
     def __init__(self, decoder=None, attributes=False, **kwargs):
         self._decoder = parse_decoding(decoder)
         self._attributes = attributes
         self._buffer = Buffer()
-        self._result = iter(self._extract_generator())
+        self._array_stack = []
+        self._last_array = None
+        self._last_attribute = None
+        # Without attributes, scalar replies need no extra handling, so we can take a shortcut for them.
+        if not attributes:
+            self.extract = self._extract_fast
 
     def feed(self, data):
         self._buffer.append(data)
 
+    # We don't do an try/finally here, since if an error occured, the connection should be closed anyhow...
     def extract(self):
-        # We don't do an try/finally here, since if an error occured, the connection should be closed anyhow...
-        return next(self._result)
-
-    def _extract_generator(self):
         buffer = self._buffer
-        array_stack = []
-        last_array = None
-        last_attribute = None
-        _need_more_data = need_more_data
-
+        data = buffer._buffer
+        parsers = self._parsers
+        types = self._types
+        attributes = self._attributes
         while True:
-            # Handle aggregate data
-            while last_array is not None:
-                # Still more data needed to fill aggregate response
-                if last_array[0] != len(last_array[1]):
+            offset = buffer._offset
+            idx = data.find(b"\r\n", offset)
+            if idx == -1:
+                return need_more_data
+            type_byte = data[offset]
+            msg = parsers[type_byte](self, data, offset + 1, idx)
+            if msg is need_more_data:
+                return need_more_data
+            elif msg is no_value:
+                last_array = self._last_array
+                if last_array is None or last_array.count != last_array.length:
+                    continue
+                msg = self._finish_aggregate()
+                if msg is no_value:
+                    continue
+            else:
+                if msg is None:
+                    if attributes:
+                        msg = Null(msg, self._last_attribute)
+                elif attributes:
+                    msg = types[type_byte](msg, self._last_attribute)
+                # We still enforce this types, because of ambiguity with other types
+                elif types[type_byte] is Error:
+                    msg = Error(msg)
+                self._last_attribute = None
+
+            # Add the value to it's aggregate, which might be completed by it
+            while True:
+                last_array = self._last_array
+                if last_array is None:
+                    buffer.compact()
+                    return msg
+                if not last_array.add(msg):
+                    break
+                msg = self._finish_aggregate()
+                if msg is no_value:
                     break
-                # Result is an array
-                if last_array[2] == 0:
-                    msg_type = Array
-                    msg = last_array[1]
-                # Result is an map
-                elif last_array[2] == 1:
-                    msg_type = Map
-                    i = iter(last_array[1])
-                    # TODO (misc) is this the best way to deal with y ?
-                    msg = OrderedDict([(bytes(y) if y.__hash__ is None else y, next(i)) for y in i])
-                # Result is an set
-                elif last_array[2] == 2:
-                    msg_type = Set
-                    msg = set(last_array[1])
-                # Result is an attribute
-                elif last_array[2] == 3:
-                    i = iter(last_array[1])
-                    # TODO (misc) is this the best way to deal with y ?
-                    last_attribute = OrderedDict([(bytes(y) if y.__hash__ is None else y, next(i)) for y in i])
-                # Result is an push
-                elif last_array[2] == 4:
-                    msg_type = Push
-                    msg = last_array[1]
-                else:
-                    raise ProtocolError("Unknown aggregate type")
-
-                # If it's an attribute, nothing to do
-                if last_array[2] == 3:
-                    if array_stack:
-                        last_array = array_stack.pop()
-                    else:
-                        last_array = None
-                else:
-                    if array_stack:
-                        tmp = array_stack.pop()
-                        if self._attributes:
-                            msg = msg_type(msg, last_array[3])
-                        # For now this isn't done, since we handle Push in unique connections
-                        # elif msg_type is Push:
-                        # msg = msg_type(msg)
-                        tmp[1].append(msg)
-                        last_array = tmp
-                    else:
-                        if self._attributes:
-                            msg = msg_type(msg, last_array[3])
-                        # For now this isn't done, since we handle Push in unique connections
-                        # elif msg_type is Push:
-                        # msg = msg_type(msg)
-                        last_array = None
-                        yield msg
-
-            # General RESP3 parsing
-            while len(buffer) == 0:
-                yield _need_more_data
 
+    # Extract up to count replies that are already in the buffer, the result might be shorter if more data is needed
+    def extract_many(self, count):
+        ret = []
+        add = ret.append
+        extract = self.extract
+        _need_more_data = need_more_data
+        while count:
+            msg = extract()
+            if msg is _need_more_data:
+                break
+            add(msg)
+            count -= 1
+        return ret
+
+    # For streaming, blob strings and arrays return a StreamHeader (and the data after it is read with extract_raw or extract accordingly), any other reply is returned complete
+    def extract_stream_header(self):
+        if self._last_array is None:
+            buffer = self._buffer
+            data = buffer._buffer
+            offset = buffer._offset
+            idx = data.find(b"\r\n", offset)
+            if idx == -1:
+                return need_more_data
+            type_byte = data[offset]
+            if (type_byte == 36 or type_byte == 42) and data[offset + 1] != 45 and data[offset + 1] != 63:
+                length = int(data[offset + 1 : idx])
+                buffer._offset = idx + 2
+                return StreamHeader(String if type_byte == 36 else Array, length)
+        return self.extract()
+
+    # Returns up to nbytes of unparsed data which is already in the buffer
+    def extract_raw(self, nbytes):
+        buffer = self._buffer
+        nbytes = min(nbytes, len(buffer))
+        if not nbytes:
+            return b""
+        ret = buffer.take(nbytes)
+        buffer.compact()
+        return ret
+
+    # Copies up to len(view) bytes of unparsed data which is already in the buffer into view, and returns how many were copied
+    def extract_raw_into(self, view):
+        buffer = self._buffer
+        nbytes = min(len(view), len(buffer))
+        if nbytes:
+            offset = buffer._offset
+            with memoryview(buffer._buffer) as data:
+                view[:nbytes] = data[offset : offset + nbytes]
+            buffer._offset = offset + nbytes
+            buffer.compact()
+        return nbytes
+
+    def _extract_fast(self):
+        if self._last_array is None:
+            buffer = self._buffer
+            data = buffer._buffer
+            offset = buffer._offset
+            idx = data.find(b"\r\n", offset)
+            if idx == -1:
+                return need_more_data
+            type_byte = data[offset]
+            # Blob string
+            if type_byte == 36 and data[offset + 1] != 45 and data[offset + 1] != 63:
+                start = idx + 2
+                length = int(data[offset + 1 : idx])
+                if len(data) < start + length + 2:
+                    return need_more_data
+                buffer._offset = start
+                msg = buffer.take(length, self._decoder)
+                buffer._offset += 2
+                buffer.compact()
+                return msg
             # Simple string
-            if buffer.skip_if_startswith(b"+"):
-                msg_type = String
-                while True:
-                    msg = buffer.takeline()
-                    if msg is not None:
-                        break
-                    yield _need_more_data
-                msg = self._decoder(msg)
-            # Simple error
-            elif buffer.skip_if_startswith(b"-"):
-                msg_type = Error
-                while True:
-                    msg = buffer.takeline()
-                    if msg is not None:
-                        break
-                    yield _need_more_data
-                msg = bytes(msg).decode("utf-8", "replace")
+            elif type_byte == 43:
+                buffer._offset = idx + 2
+                return self._decoder(data[offset + 1 : idx])
             # Number
-            elif buffer.skip_if_startswith(b":"):
-                msg_type = Number
-                while True:
-                    msg = buffer.takeline()
-                    if msg is not None:
-                        break
-                    yield _need_more_data
-                msg = int(msg)
-            # Blob string and Verbatim string
-            elif buffer.skip_if_startswith(b"$") or buffer.skip_if_startswith(b"="):
-                msg_type = String
-                while True:
-                    length = buffer.takeline()
-                    if length is not None:
-                        break
-                    yield _need_more_data
-                # Streamed string
-                if length == b"?":
-                    chunks = []
-                    while True:
-                        while True:
-                            chunk_size = buffer.takeline()
-                            if chunk_size is not None:
-                                break
-                            yield _need_more_data
-                        chunk_size = bytes(chunk_size)
-                        assert chunk_size[0] == 59
-                        chunk_size = int(chunk_size[1:])
-                        if chunk_size == 0:
-                            break
-                        while True:
-                            if len(buffer) >= chunk_size + 2:
-                                break
-                            yield _need_more_data
-                        chunks.append(buffer.take(chunk_size))
-                        buffer.skip(2)
-                    msg = self._decoder(b"".join(chunks))
-                    chunks = None
-                else:
-                    length = int(length)
-                    # Legacy RESP2 support
-                    if length == -1:
-                        msg = None
-                        msg_type = Null
-                    else:
-                        while True:
-                            if len(buffer) >= length + 2:
-                                break
-                            yield _need_more_data
-                        msg = self._decoder(buffer.take(length))
-                        buffer.skip(2)
-            # Array
-            elif buffer.skip_if_startswith(b"*"):
-                while True:
-                    length = buffer.takeline()
-                    if length is not None:
-                        break
-                    yield _need_more_data
-                # Streamed array
-                if length == b"?":
-                    length = None
-                else:
-                    length = int(length)
-                # Legacy RESP2 support
-                if length == -1:
-                    msg = None
-                    msg_type = Null
-                else:
-                    if last_array is not None:
-                        array_stack.append(last_array)
-                    last_array = [length, [], 0, last_attribute]
-                    last_attribute = None
-                    continue
-            # Set
-            elif buffer.skip_if_startswith(b"~"):
-                while True:
-                    length = buffer.takeline()
-                    if length is not None:
-                        break
-                    yield _need_more_data
-                # Streamed set
-                if length == b"?":
-                    length = None
-                else:
-                    length = int(length)
-                # Legacy RESP2 support
-                if length == -1:
-                    msg = None
-                    msg_type = Null
-                else:
-                    if last_array is not None:
-                        array_stack.append(last_array)
-                    last_array = [length, [], 2, last_attribute]
-                    last_attribute = None
-                    continue
-            # Null
-            elif buffer.skip_if_startswith(b"_"):
-                msg_type = Null
-                while True:
-                    line = buffer.takeline()
-                    if line is not None:
-                        break
-                    yield _need_more_data
-                assert len(line) == 0
-                msg = None
-            # Double
-            elif buffer.skip_if_startswith(b","):
-                msg_type = Double
-                while True:
-                    msg = buffer.takeline()
-                    if msg is not None:
-                        break
-                    yield _need_more_data
-                msg = float(msg)
-            # Boolean
-            elif buffer.skip_if_startswith(b"#"):
-                msg_type = Boolean
-                while True:
-                    msg = buffer.takeline()
-                    if msg is not None:
-                        break
-                    yield _need_more_data
-                if msg == b"t":
-                    msg = True
-                elif msg == b"f":
-                    msg = False
-            # Blob error
-            elif buffer.skip_if_startswith(b"!"):
-                msg_type = Error
-                while True:
-                    length = buffer.takeline()
-                    if length is not None:
-                        break
-                    yield _need_more_data
-                length = int(length)
-                # Legacy RESP2 support
-                if length == -1:
-                    msg = None
-                    msg_type = Null
-                else:
-                    while True:
-                        if len(buffer) >= length + 2:
-                            break
-                        yield _need_more_data
-                    msg = buffer.take(length)
-                    buffer.skip(2)
-                    msg = bytes(msg).decode("utf-8", "replace")
-            # Big number
-            elif buffer.skip_if_startswith(b"("):
-                msg_type = BigNumber
-                while True:
-                    msg = buffer.takeline()
-                    if msg is not None:
-                        break
-                    yield _need_more_data
-                msg = int(msg)
-            # Map
-            elif buffer.skip_if_startswith(b"%"):
-                while True:
-                    length = buffer.takeline()
-                    if length is not None:
-                        break
-                    yield _need_more_data
-                # Streamed map
-                if length == b"?":
-                    length = None
-                else:
-                    length = int(length) * 2
-                # Legacy RESP2 support
-                if length == -1:
-                    msg = None
-                    msg_type = Null
-                else:
-                    if last_array is not None:
-                        array_stack.append(last_array)
-                    last_array = [length, [], 1, last_attribute]
-                    last_attribute = None
-                    continue
-            # Attribute
-            elif buffer.skip_if_startswith(b"|"):
-                while True:
-                    length = buffer.takeline()
-                    if length is not None:
-                        break
-                    yield _need_more_data
-                length = int(length) * 2
-                # Legacy RESP2 support
-                if length == -1:
-                    msg = None
-                    msg_type = Null
-                else:
-                    if last_array is not None:
-                        array_stack.append(last_array)
-                    last_array = [length, [], 3]
-                    continue
-            # Push
-            elif buffer.skip_if_startswith(b">"):
-                while True:
-                    length = buffer.takeline()
-                    if length is not None:
-                        break
-                    yield _need_more_data
-                length = int(length)
-                # Legacy RESP2 support
-                if length == -1:
-                    msg = None
-                    msg_type = Null
-                else:
-                    if last_array is not None:
-                        array_stack.append(last_array)
-                    last_array = [length, [], 4, last_attribute]
-                    last_attribute = None
-                    continue
-            # End of streaming aggregate type
-            elif buffer.skip_if_startswith(b"."):
-                while True:
-                    tmp = buffer.takeline()
-                    if tmp is not None:
-                        break
-                    yield _need_more_data
-                assert tmp == b""
-                assert last_array[0] == None
-                last_array[0] = len(last_array[1])
-                continue
-            else:
-                raise ProtocolError("Unknown type: %s" % bytes(buffer.take(1)).decode())
+            elif type_byte == 58:
+                buffer._offset = idx + 2
+                return int(data[offset + 1 : idx])
+        return RedisRespDecoder.extract(self)
+
+    def _start_aggregate(self, aggregate_class, result_type, length):
+        if self._last_array is not None:
+            self._array_stack.append(self._last_array)
+        self._last_array = aggregate_class(result_type, length, self._last_attribute)
+        self._last_attribute = None
+        return no_value
+
+    def _finish_aggregate(self):
+        last_array = self._last_array
+        self._last_array = self._array_stack.pop() if self._array_stack else None
+        msg_type = last_array.result_type
+        # Result is an attribute, it will be attached to the next value
+        if msg_type is None:
+            self._last_attribute = last_array.data
+            return no_value
+        # Result is an streamed string
+        elif msg_type is String:
+            msg = self._decoder(b"".join(last_array.data))
+        else:
+            msg = last_array.data
+        if self._attributes:
+            msg = msg_type(msg, last_array.attr)
+        # For now this isn't done, since we handle Push in unique connections
+        # elif msg_type is Push:
+        # msg = msg_type(msg)
+        return msg
+
+    def _parse_unknown(self, data, start, end):
+        raise ProtocolError("Unknown type: %s" % chr(data[start - 1]))
+
+    def _parse_simple_string(self, data, start, end):
+        self._buffer._offset = end + 2
+        return self._decoder(data[start:end])
+
+    def _parse_simple_error(self, data, start, end):
+        self._buffer._offset = end + 2
+        return decode_error(data[start:end])
+
+    def _parse_number(self, data, start, end):
+        self._buffer._offset = end + 2
+        return int(data[start:end])
+
+    def _parse_blob(self, data, start, end, decoder):
+        buffer = self._buffer
+        length = int(data[start:end])
+        # Legacy RESP2 support
+        if length == -1:
+            buffer._offset = end + 2
+            return None
+        if len(data) < end + length + 4:
+            return need_more_data
+        buffer._offset = end + 2
+        msg = buffer.take(length, decoder)
+        buffer._offset += 2
+        return msg
+
+    # Blob string and Verbatim string
+    def _parse_blob_string(self, data, start, end):
+        # Streamed string
+        if data[start:end] == b"?":
+            self._buffer._offset = end + 2
+            return self._start_aggregate(ArrayAggregate, String, None)
+        return self._parse_blob(data, start, end, self._decoder)
+
+    def _parse_blob_error(self, data, start, end):
+        return self._parse_blob(data, start, end, decode_error)
+
+    # Streamed string chunk
+    def _parse_chunk(self, data, start, end):
+        last_array = self._last_array
+        if last_array is None or last_array.result_type is not String:
+            raise ProtocolError("Got a string chunk outside of a streamed string")
+        length = int(data[start:end])
+        if length == 0:
+            self._buffer._offset = end + 2
+            last_array.length = last_array.count
+            return no_value
+        msg = self._parse_blob(data, start, end, bytes)
+        if msg is need_more_data:
+            return msg
+        last_array.add(msg)
+        return no_value
+
+    def _parse_aggregate(self, data, start, end, aggregate_class, result_type):
+        self._buffer._offset = end + 2
+        length = data[start:end]
+        # Streamed aggregate
+        if length == b"?":
+            return self._start_aggregate(aggregate_class, result_type, None)
+        length = int(length)
+        # Legacy RESP2 support
+        if length == -1:
+            return None
+        # Maps and attributes contain key and value for each entry
+        if aggregate_class is MapAggregate:
+            length *= 2
+        return self._start_aggregate(aggregate_class, result_type, length)
+
+    def _parse_array(self, data, start, end):
+        return self._parse_aggregate(data, start, end, ArrayAggregate, Array)
+
+    def _parse_map(self, data, start, end):
+        return self._parse_aggregate(data, start, end, MapAggregate, Map)
+
+    def _parse_set(self, data, start, end):
+        return self._parse_aggregate(data, start, end, SetAggregate, Set)
+
+    def _parse_attribute(self, data, start, end):
+        # The attribute applies to the value after it, so we don't want to clear it yet
+        last_attribute = self._last_attribute
+        ret = self._parse_aggregate(data, start, end, MapAggregate, None)
+        if ret is no_value:
+            self._last_array.attr = None
+        self._last_attribute = last_attribute
+        return ret
 
-            # Handle legacy RESP2 Null
-            if msg is None and msg_type is not Null:
-                msg_type = Null
+    def _parse_push(self, data, start, end):
+        return self._parse_aggregate(data, start, end, ArrayAggregate, Push)
+
+    # End of streaming aggregate type
+    def _parse_end(self, data, start, end):
+        last_array = self._last_array
+        if last_array is None or last_array.length is not None:
+            raise ProtocolError("Got an end of aggregate outside of a streamed aggregate")
+        self._buffer._offset = end + 2
+        last_array.length = last_array.count
+        return no_value
+
+    def _parse_null(self, data, start, end):
+        self._buffer._offset = end + 2
+        return None
+
+    def _parse_double(self, data, start, end):
+        self._buffer._offset = end + 2
+        return float(data[start:end])
+
+    def _parse_boolean(self, data, start, end):
+        self._buffer._offset = end + 2
+        msg = data[start:end]
+        if msg == b"t":
+            return True
+        elif msg == b"f":
+            return False
+        raise ProtocolError("Invalid boolean value")
+
+    _parsers = build_dispatch_table(
+        {
+            "+": _parse_simple_string,
+            "-": _parse_simple_error,
+            ":": _parse_number,
+            "$": _parse_blob_string,
+            "=": _parse_blob_string,
+            ";": _parse_chunk,
+            "*": _parse_array,
+            "~": _parse_set,
+            "_": _parse_null,
+            ",": _parse_double,
+            "#": _parse_boolean,
+            "!": _parse_blob_error,
+            "(": _parse_number,
+            "%": _parse_map,
+            "|": _parse_attribute,
+            ">": _parse_push,
+            ".": _parse_end,
+        },
+        _parse_unknown,
+    )
+
+    # The result type of each scalar value (when attributes are enabled)
+    _types = build_dispatch_table({"+": String, "-": Error, ":": Number, "$": String, "=": String, "_": Null, ",": Double, "#": Boolean, "!": Error, "(": BigNumber}, None)
+
+
+def parse_hiredis_decoding(decoding):
+    if decoding is None:
+        return {}
+    elif isinstance(decoding, str):
+        return {"encoding": decoding}
+    elif isinstance(decoding, (tuple, list)):
+        return dict(zip(("encoding", "errors"), decoding))
+    elif isinstance(decoding, dict):
+        return dict(decoding)
+    else:
+        raise ValueError("Invalid decoding: %r" % decoding)
 
-            if self._attributes:
-                msg = msg_type(msg, last_attribute)
-            # We still enforce this types, because of ambiguity with other types
-            elif msg_type == Error:
-                msg = msg_type(msg)
 
-            last_attribute = None
+# RESP2 replies carry no attributes and no type information beyond what the Python types already tell us, so this is the same result the pure Python decoder gives.
+def wrap_with_attributes(msg):
+    if isinstance(msg, Error):
+        return Error(msg.data, None)
+    elif isinstance(msg, list):
+        return Array([wrap_with_attributes(x) for x in msg], None)
+    elif msg is None:
+        return Null(None, None)
+    elif isinstance(msg, int):
+        return Number(msg, None)
+    else:
+        return String(msg, None)
 
-            if last_array:
-                last_array[1].append(msg)
-            else:
-                yield msg
+
+# A compiled decoder for RESP2 only, used automatically if the hiredis library is installed.
+class HiredisRespDecoder:
+    def __init__(self, decoder=None, attributes=False, **kwargs):
+        self._attributes = attributes
+        self._reader = hiredis.Reader(protocolError=ProtocolError, replyError=Error, **parse_hiredis_decoding(decoder))
+
+    def feed(self, data):
+        self._reader.feed(data)
+
+    def extract(self):
+        msg = self._reader.gets()
+        if msg is False:
+            return need_more_data
+        if self._attributes:
+            return wrap_with_attributes(msg)
+        return msg
+
+    def extract_many(self, count):
+        ret = []
+        add = ret.append
+        gets = self._reader.gets
+        attributes = self._attributes
+        while count:
+            msg = gets()
+            if msg is False:
+                break
+            if attributes:
+                msg = wrap_with_attributes(msg)
+            add(msg)
+            count -= 1
+        return ret
+
+
+def create_decoder(parser="auto", resp_version=2, **kwargs):
+    if parser == "auto":
+        if hiredis is not None and resp_version == 2:
+            parser = "hiredis"
+        else:
+            parser = "python"
+    if parser == "python":
+        return RedisRespDecoder(**kwargs)
+    elif parser == "hiredis":
+        if hiredis is None:
+            raise ValueError("The hiredis parser requires the hiredis library to be installed")
+        if resp_version != 2:
+            raise ValueError("The hiredis parser supports only RESP2 (resp_version=2)")
+        return HiredisRespDecoder(**kwargs)
+    else:
+        raise ValueError("Unknown parser: %s" % parser)
@@ -1,20 +1,88 @@
 from collections import deque
+from functools import partial
+
+
+# The encodings of common small integers are cached
+small_int_min = -1
+small_int_max = 10000
+small_ints = [b"%d" % i for i in range(small_int_min, small_int_max + 1)]
+
+default_cutoff_size = 6000
+
+# Encoders for user types, the result may be any supported type (i.e. register_encoder(Decimal, str))
+custom_encoders = {}
+# Changes on every (un)registration, so the encoders resolved for other classes are looked up again
+custom_encoders_version = 0
+
+
+def register_encoder(cls, encoder):
+    global custom_encoders_version
+    custom_encoders[cls] = encoder
+    custom_encoders_version += 1
+
+
+def unregister_encoder(cls):
+    global custom_encoders_version
+    custom_encoders.pop(cls, None)
+    custom_encoders_version += 1
+
+
+def encode_as_is(inp):
+    return inp
+
+
+def encode_int(inp):
+    if small_int_min <= inp <= small_int_max:
+        return small_ints[inp - small_int_min]
+    return b"%d" % inp
+
+
+def encode_float(inp):
+    return b"%r" % inp
 
 
 def encode(encoding="utf-8", errors="strict"):
-    def encode_with_encoding(inp, encoding=encoding, errors=errors):
-        if isinstance(inp, (bytes, bytearray, memoryview)):
-            return inp
-        elif isinstance(inp, str):
-            return inp.encode(encoding, errors)
-        elif isinstance(inp, bool):
-            raise ValueError("Invalid input for encoding")
-        elif isinstance(inp, int):
-            return b"%d" % inp
-        elif isinstance(inp, float):
-            return b"%r" % inp
+    def encode_str(inp):
+        return inp.encode(encoding, errors)
+
+    encoders = {bytes: encode_as_is, bytearray: encode_as_is, memoryview: encode_as_is, str: encode_str, int: encode_int, float: encode_float}
+
+    def encode_custom(inp, encoder):
+        return encode_with_encoding(encoder(inp))
+
+    def find_encoder(cls):
+        encoder = custom_encoders.get(cls)
+        if encoder is not None:
+            return partial(encode_custom, encoder=encoder)
+        # Subclasses of the supported types, and registered base classes
+        for base in cls.__mro__:
+            encoder = custom_encoders.get(base)
+            if encoder is not None:
+                return partial(encode_custom, encoder=encoder)
+            # A bool is an int, but we won't guess how it should be encoded
+            if base is bool:
+                break
+            encoder = encoders.get(base)
+            if encoder is not None:
+                return encoder
         raise ValueError("Invalid input for encoding")
 
+    # The encoders found for other classes (custom and subclasses), until the custom encoders change
+    resolved = {}
+    resolved_version = custom_encoders_version
+
+    def encode_with_encoding(inp):
+        nonlocal resolved_version
+        encoder = encoders.get(inp.__class__)
+        if encoder is None:
+            if resolved_version != custom_encoders_version:
+                resolved.clear()
+                resolved_version = custom_encoders_version
+            encoder = resolved.get(inp.__class__)
+            if encoder is None:
+                encoder = resolved[inp.__class__] = find_encoder(inp.__class__)
+        return encoder(inp)
+
     return encode_with_encoding
 
 
@@ -34,9 +102,47 @@ def parse_encoding(encoding):
         raise ValueError("Invalid encoding: %r" % encoding)
 
 
+# The command name, which carries the pre-encoded constant parts of the command, None arguments are filled on bind()
+class PreparedCommand(bytes):
+    def __new__(cls, *cmd, encoder=None):
+        if not cmd:
+            raise ValueError("No command provided")
+        encoder = parse_encoding(encoder)
+        self = super(PreparedCommand, cls).__new__(cls, encoder(cmd[0]))
+        self._template = (self,) + cmd[1:]
+        self._positions = tuple(index for index, arg in enumerate(cmd) if arg is None)
+        if 0 in self._positions:
+            raise ValueError("The command name cannot be a variable argument")
+        # A list of (constant data, variable argument position) and the trailing constant data
+        parts = []
+        constant = [b"*%d\r\n" % len(cmd)]
+        for index, arg in enumerate(self._template):
+            if arg is None:
+                parts.append((b"".join(constant), index))
+                constant = []
+                continue
+            arg = encoder(arg)
+            if isinstance(arg, memoryview):
+                arg = arg.tobytes()
+            constant.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self._parts = tuple(parts)
+        self._tail = b"".join(constant)
+        return self
+
+    # Returns the full command (which can be used in a pipeline as well)
+    def bind(self, *args):
+        positions = self._positions
+        if len(args) != len(positions):
+            raise ValueError("Expected %d arguments, got %d" % (len(positions), len(args)))
+        cmd = list(self._template)
+        for index, arg in zip(positions, args):
+            cmd[index] = arg
+        return cmd
+
+
 # We add data to encode in 2 steps to avoid an invalid encoding causing to drop the connections
 class RedisRespEncoder:
-    def __init__(self, encoder=None, cutoff_size=6000, **kwargs):
+    def __init__(self, encoder=None, cutoff_size=default_cutoff_size, **kwargs):
         self._encoder = parse_encoding(encoder)
         self._cutoff_size = cutoff_size
         self._chunks = deque()
@@ -44,35 +150,50 @@ class RedisRespEncoder:
     def encode(self, *cmd):
         data = []
         add_data = data.append
+        if isinstance(cmd[0], PreparedCommand) and len(cmd) == len(cmd[0]._template):
+            self._encode_prepared(cmd, add_data)
+        else:
+            add_data(b"*%d\r\n" % len(cmd))
+            self._encode_arguments(cmd, add_data)
+        self._chunks.extend(data)
+
+    def encode_multiple(self, *cmds):
+        data = []
+        add_data = data.append
+        for cmd in cmds:
+            if isinstance(cmd[0], PreparedCommand) and len(cmd) == len(cmd[0]._template):
+                self._encode_prepared(cmd, add_data)
+                continue
+            add_data(b"*%d\r\n" % len(cmd))
+            self._encode_arguments(cmd, add_data)
+        self._chunks.extend(data)
+
+    # Only the variable arguments are encoded, the rest is taken as is from the template
+    def _encode_prepared(self, cmd, add_data):
+        for constant, index in cmd[0]._parts:
+            if constant:
+                add_data(constant)
+            self._encode_arguments((cmd[index],), add_data)
+        tail = cmd[0]._tail
+        if tail:
+            add_data(tail)
+
+    def _encode_arguments(self, args, add_data):
         encoder = self._encoder
-        add_data(b"*%d\r\n" % len(cmd))
-        for arg in cmd:
+        merge_size = self._cutoff_size or 0
+        for arg in args:
             arg = encoder(arg)
             if isinstance(arg, memoryview):
                 length = arg.nbytes
             else:
                 length = len(arg)
+                # Small arguments are merged with their header to a single chunk
+                if length < merge_size:
+                    add_data(b"$%d\r\n%s\r\n" % (length, arg))
+                    continue
             add_data(b"$%d\r\n" % length)
             add_data(arg)
             add_data(b"\r\n")
-        self._chunks.extend(data)
-
-    def encode_multiple(self, *cmds):
-        data = []
-        add_data = data.append
-        encoder = self._encoder
-        for cmd in cmds:
-            add_data(b"*%d\r\n" % len(cmd))
-            for arg in cmd:
-                arg = encoder(arg)
-                if isinstance(arg, memoryview):
-                    length = arg.nbytes
-                else:
-                    length = len(arg)
-                add_data(b"$%d\r\n" % length)
-                add_data(arg)
-                add_data(b"\r\n")
-        self._chunks.extend(data)
 
     def extract(self):
         cutoff_size = self._cutoff_size
@@ -102,3 +223,35 @@ class RedisRespEncoder:
             else:
                 ret.append(item)
                 length += item_len
+
+    # Returns a list of buffers for a vectored send, runs of small chunks are coalesced and big ones are returned as is
+    def extract_vector(self, max_buffers=512):
+        # Big arguments are never copied, even if appending was disabled
+        cutoff_size = self._cutoff_size or default_cutoff_size
+        chunks = self._chunks
+        if not chunks:
+            return None
+        ret = []
+        add_ret = ret.append
+        small = []
+        small_length = 0
+        # Each iteration adds at most 2 buffers
+        while chunks and len(ret) < max_buffers - 1:
+            item = chunks.popleft()
+            item_len = len(item)
+            if item_len > cutoff_size:
+                if small:
+                    add_ret(b"".join(small))
+                    small = []
+                    small_length = 0
+                add_ret(item)
+            else:
+                small.append(item)
+                small_length += item_len
+                if small_length > cutoff_size:
+                    add_ret(b"".join(small))
+                    small = []
+                    small_length = 0
+        if small:
+            add_ret(b"".join(small))
+        return ret
@@ -1,17 +1,22 @@
+from array import array
 from binascii import crc_hqx
 
 try:
     from contextlib import asynccontextmanager
 except:
     from async_generator import asynccontextmanager
+from functools import partial
 from random import choice
+from time import monotonic
 
 from .environment import get_environment
 from .connectionpool import ConnectionPool
-from ..decoder import Error, Result
-from ..utils import is_multiple_commands
-from ..encoder import parse_encoding
-from ..errors import CommunicationError
+from .connection import ReplyStream
+from ..decoder import Error, Result, Number, Array
+from ..utils import get_command_name, is_multiple_commands, can_auto_pipeline, parse_redirection
+from ..encoder import parse_encoding, PreparedCommand
+from ..errors import CommunicationError, ConnectionPoolError, PipelinedExceptions
+from ..commands import static_commands, movable_keys
 
 
 def calc_hashslot(key):
@@ -23,6 +28,20 @@ def calc_hashslot(key):
     return crc_hqx(key, 0) % 16384
 
 
+# Marks a hashslot which is not served by any server in the slots table
+no_node = 0xFFFF
+
+# Keyless commands are spread on the healthy masters whose latency is up to this ratio of the fastest one (plus a millisecond of jitter)
+keyless_latency_ratio = 1.5
+# How often (in seconds) the masters for the keyless commands are picked again
+keyless_refresh_interval = 1
+
+
+# Multi key commands which are split by hashslot in a cluster, and how their replies are merged
+# "keys" = A reply item per key, "sum" = The replies are added, "first" = The replies are the same
+split_commands = {b"MGET": "keys", b"MSET": "first", b"DEL": "sum", b"UNLINK": "sum", b"EXISTS": "sum", b"TOUCH": "sum"}
+
+
 # TODO (correctness) I think I covered the multithreading sensetive parts, make sure
 # TODO (misc) should I lazely check if there is a cluster ? (i.e. upgrade from a default connectionpool first)
 # TODO (correctness) thinkg about how to ASK redirect in connection taking and pipelining
@@ -34,7 +53,7 @@ def calc_hashslot(key):
 
 
 class ClusterConnectionPool:
-    def __init__(self, addresses=None, **kwargs):
+    def __init__(self, addresses=None, slots_refresh_interval=1, read_from="master", fanout_limit=32, **kwargs):
         address = kwargs.pop("address", None)
         if addresses is None:
             if address:
@@ -43,17 +62,30 @@ class ClusterConnectionPool:
                 addresses = (("localhost", 6379),)
         elif address is not None:
             raise ValueError("Do not provide both addresses, and address")
+        if read_from not in ("master", "replica", "random", "latency"):
+            raise ValueError("Unsupported read_from policy %s" % read_from)
         self._initial_addresses = addresses
         self._settings = kwargs
+        self._auto_pipeline = kwargs.get("auto_pipeline", False)
         self._connections = {}
-        self._lock = get_environment(**kwargs).lock()
+        self._environment = get_environment(**kwargs)
+        self._lock = self._environment.lock()
         self._last_connection = None
         self._last_connection_peername = None
-        self._slots = []
+        # A tuple of the masters addresses, a table of the index in it for each hashslot, and a tuple of each master's replicas addresses
+        self._slots = ((), None, ())
+        self._replica_addresses = ()
+        self._read_from = read_from
+        self._fanout_limit = fanout_limit
+        self._slots_refresh_interval = slots_refresh_interval
+        self._last_slots_refresh = None
         # None = unknown, False = Nop, True = Yep
         self._clustered = None
         # Command info results
-        self._command_cache = {}
+        self._command_cache = dict(static_commands) if kwargs.get("command_table") == "static" else {}
+        self._command_table_loaded = False
+        # The masters the keyless commands are spread on: the nodes they were picked from, the picked ones and until when they are used
+        self._keyless = None
         self._closed = False
 
     async def aclose(self):
@@ -69,6 +101,7 @@ class ClusterConnectionPool:
         # TODO (misc) or if there is a hint from MOVED, recheck if clustered?
         if self._clustered == False:
             return
+        self._last_slots_refresh = monotonic()
         conn = await self.take()
         try:
             slots = await conn(b"CLUSTER", b"SLOTS")
@@ -82,44 +115,141 @@ class ClusterConnectionPool:
             raise
         finally:
             await self.release(conn)
-        # TODO (misc) what todo about holes in hashslots in response ?
         if isinstance(slots, Result):
             slots = slots.data
-        slots.sort(key=lambda x: x[0])
         if slots and isinstance(slots[0][2][0], bytes):
-            slots = [(x[1], (x[2][0].decode(), x[2][1])) for x in slots]
+            slots = [(x[0], x[1], (x[2][0].decode(), x[2][1]), tuple((y[0].decode(), y[1]) for y in x[3:])) for x in slots]
         else:
-            slots = [(x[1], (x[2][0], x[2][1])) for x in slots]
+            slots = [(x[0], x[1], (x[2][0], x[2][1]), tuple((y[0], y[1]) for y in x[3:])) for x in slots]
         # We weren't in a cluster before, and we aren't now
-        if self._clustered == False and not self._slots:
+        if self._clustered == False and not self._slots[0]:
             return
+        nodes = []
+        replicas = []
+        indexes = {}
+        slot_table = array("H", (no_node,)) * 16384
+        for start, end, address, address_replicas in slots:
+            index = indexes.get(address)
+            if index is None:
+                index = indexes[address] = len(nodes)
+                nodes.append(address)
+                replicas.append(address_replicas)
+            slot_table[start : end + 1] = array("H", (index,)) * (end + 1 - start)
+        # Holes are left as no_node, and are checked again when used (they can be in the middle of a resharding)
+        nodes = tuple(nodes)
+        replicas = tuple(replicas)
+        replica_addresses = tuple(dict.fromkeys(address for address_replicas in replicas for address in address_replicas))
         # Remove connections which are not a part of the cluster anymore
         async with self._lock:
             previous_connections = set(self._connections.keys())
-            new_connections = set([x[1] for x in slots])
+            new_connections = set(nodes + replica_addresses)
             connections_to_remove = previous_connections - new_connections
-            for address in connections_to_remove:
-                await self._connections[address].aclose()
-                del self._connections[address]
-            self._slots = slots
+            # Servers which changed between master and replica need new connections (READONLY or not)
+            connections_to_remove.update(previous_connections.intersection(set(self._replica_addresses).symmetric_difference(replica_addresses)))
+            pools_to_close = [self._connections.pop(address) for address in connections_to_remove]
+            self._slots = (nodes, slot_table, replicas)
+            self._replica_addresses = replica_addresses
 
             if connections_to_remove:
                 # TODO (misc) an optimization can only do this if it's not in new_connections
                 self._last_connection = self._last_connection_peername = None
+        # The pools are closed outside the lock, they are not reachable anymore
+        for pool in pools_to_close:
+            await pool.aclose()
+        # Open the connections to the servers now, instead of on their first command
+        if self._settings.get("prewarm") and self._settings.get("min_connections"):
+            addresses = nodes + replica_addresses if self._read_from != "master" else nodes
+            await self._environment.gather(*[self._address_pool(address).prewarm for address in addresses])
 
-    async def _connection_by_hashslot(self, hashslot):
-        if not self._slots:
+    # Other callers skip the refresh if one was done (or is running) in the last slots_refresh_interval seconds
+    async def _refresh_slots(self):
+        if self._last_slots_refresh is not None and monotonic() - self._last_slots_refresh < self._slots_refresh_interval:
+            return
+        await self._update_slots()
+
+    # Patches the slots table from a MOVED redirection, instead of fetching all of the slots again for each moved key
+    async def _moved(self, redirection):
+        hashslot, address = redirection
+        async with self._lock:
+            nodes, slot_table, replicas = self._slots
+            if slot_table is not None:
+                if address in nodes:
+                    slot_table[hashslot] = nodes.index(address)
+                else:
+                    # Readers might be using the previous nodes, so the table is copied
+                    slot_table = array("H", slot_table)
+                    slot_table[hashslot] = len(nodes)
+                    self._slots = (nodes + (address,), slot_table, replicas + ((),))
+        # Resharding moves more than a single hashslot, so get the full picture later
+        await self._refresh_slots()
+
+    # Servers without a connection pool yet are considered healthy
+    def _healthy(self, address):
+        pool = self._connections.get(address)
+        return pool is None or pool.healthy()
+
+    def _address_latency(self, address):
+        pool = self._connections.get(address)
+        latency = pool.latency() if pool is not None else None
+        return latency or 0
+
+    # Servers without a latency measurement yet are tried first
+    def _fastest(self, addresses):
+        return min(addresses, key=self._address_latency)
+
+    # Keyless commands go to one of the fastest healthy masters, which are picked again once in a while (or when one is ejected)
+    def _keyless_address(self, nodes):
+        keyless = self._keyless
+        now = monotonic()
+        if keyless is not None and keyless[0] is nodes and now < keyless[2]:
+            address = choice(keyless[1])
+            if self._healthy(address):
+                return address
+        addresses = [node for node in nodes if self._healthy(node)] or nodes
+        latencies = [self._address_latency(address) for address in addresses]
+        limit = min(latencies) * keyless_latency_ratio + 0.001
+        addresses = [address for address, latency in zip(addresses, latencies) if latency <= limit]
+        self._keyless = (nodes, addresses, now + keyless_refresh_interval)
+        return choice(addresses)
+
+    # Picks the server for a read only command by the read_from policy, skipping ejected servers
+    def _read_address(self, master, replicas):
+        if not replicas:
+            return master
+        addresses = [address for address in (master,) + replicas if self._healthy(address)]
+        if self._read_from == "replica":
+            addresses = [address for address in addresses if address != master] or addresses
+        if not addresses:
+            return master
+        if self._read_from == "latency":
+            return self._fastest(addresses)
+        return choice(addresses)
+
+    # Returns None if not in a cluster
+    async def _address_by_hashslot(self, hashslot, read=False):
+        nodes, slot_table, replicas = self._slots
+        if not nodes:
             await self._update_slots()
+            nodes, slot_table, replicas = self._slots
         if self._clustered == False:
-            return await self.take()
-        if not self._slots:
+            return None
+        if not nodes:
             # TODO (misc) Is this the correct exception type?
             raise ValueError("Could not find any slots in the redis cluster")
-        for slot in self._slots:
-            if hashslot <= slot[0]:
-                break
-        address = slot[1]
-        return await self.take(address)
+        index = slot_table[hashslot]
+        if index == no_node:
+            # Maybe our view of the slots is old, this is checked once even if the slots were just refreshed
+            await self._update_slots()
+            nodes, slot_table, replicas = self._slots
+            index = slot_table[hashslot] if nodes else no_node
+            if index == no_node:
+                raise ValueError("Hashslot %d is not served by any server in the redis cluster" % hashslot)
+        if read and self._read_from != "master":
+            return self._read_address(nodes[index], replicas[index])
+        return nodes[index]
+
+    async def _connection_by_hashslot(self, hashslot):
+        return await self.take(await self._address_by_hashslot(hashslot))
 
     async def _get_info_for_command(self, *cmd):
         # commands are ascii, yes ? some commands can be larger than cmd[0] for index ? meh, let's be optimistic for now
@@ -129,70 +259,101 @@ class ClusterConnectionPool:
             command = encode("ascii")
         command = command.upper()
         info = self._command_cache.get(command)
-        if info:
+        if info is not None or self._command_table_loaded:
             return info
+        await self._load_command_table()
+        return self._command_cache.get(command)
+
+    # The whole command table is fetched once, instead of a COMMAND INFO per command
+    async def _load_command_table(self):
         conn = await self.take()
         try:
-            command_info = await conn(b"COMMAND", b"INFO", command)
+            commands = await conn(b"COMMAND", attributes=False, decoder=None)
         except Exception:
             # This is done to invalidate a potentially bad server, and pick up another one randomally next try
             self._last_connection = self._last_connection_peername = None
             raise
         finally:
             await self.release(conn)
-        if isinstance(command_info, Result):
-            command_info = command_info.data
-        command_info = command_info[0]
-        # TODO (misc) on null, cache it too ?
-        if command_info:
-            self._command_cache[command] = command_info
-        return command_info
+        for info in commands:
+            if info:
+                self._command_cache[info[0].upper()] = info
+        self._command_table_loaded = True
 
+    # Returns the command's first key, None if it has no keys, or False if it can't be found client side
+    def _first_key(self, cmd, info):
+        index = info[3]
+        if index != 0:
+            return cmd[index] if len(cmd) > index else None
+        first_key = movable_keys.get(get_command_name(cmd))
+        if first_key is not None:
+            return first_key(cmd)
+        if b"movablekeys" in info[2]:
+            return False
+        return None
+
+    # Creating a pool does not connect (there is no await here), so it does not need the lock
     def _address_pool(self, address):
         pool = self._connections.get(address)
         if pool is None:
-            # with self._lock:
-            pool = self._connections.get(address)
-            if pool is None:
-                pool = ConnectionPool(address=address, **self._settings)
-                self._connections[address] = pool
+            pool = ConnectionPool(address=address, readonly=address in self._replica_addresses, **self._settings)
+            self._connections[address] = pool
         return pool
 
+    # A slots update might close the pool after it was looked up (without the lock), so the lookup is retried
+    async def _take_from(self, address):
+        while True:
+            pool = self._address_pool(address)
+            try:
+                return await pool.take()
+            except ConnectionPoolError:
+                if self._closed or not pool._closed or self._connections.get(address) is pool:
+                    raise
+
     # TODO (misc) make sure the address got here from _slots (or risk stale data)
+    # Connecting is done outside of the lock, so a slow server does not hold back the other servers
     async def take(self, address=None):
-        # if address:
-        # return self._address_pool(address).take()
-        # TODO (misc) is this best ?
-        async with self._lock:
-            if address:
-                return await self._address_pool(address).take()
-            if self._last_connection:
-                try:
-                    # TODO (misc) maybe do a health check here ? if there is an exception it will be invalidated anyhow for the next time...
-                    return await self._last_connection.take()
-                except Exception:
-                    self._last_connection = None
-            endpoints = [x[1] for x in self._slots.copy()]
-            # TODO (correctness) maybe after I/O failure (repeated?) always go back to initial address ? or just remove an entry from the connection when it's invalid, till it's empty ?
-            if not endpoints:
-                endpoints = self._initial_addresses
-            # TODO (correctness) should we pick up randomally, or go each one in the list on each failure ?
-            address = choice(endpoints)
-            pool = self._address_pool(address)
-            self._last_connection = pool
-            # TODO (corectness) on error, try the next one immidiatly
-            conn = await self._last_connection.take()
-            self._last_connection_peername = conn.peername()
-            return conn
+        if address:
+            return await self._take_from(address)
+        nodes = self._slots[0]
+        if self._clustered and nodes:
+            self._last_connection = self._address_pool(self._keyless_address(nodes))
+        pool = self._last_connection
+        if pool:
+            try:
+                # TODO (misc) maybe do a health check here ? if there is an exception it will be invalidated anyhow for the next time...
+                return await pool.take()
+            except Exception:
+                self._last_connection = None
+        endpoints = nodes
+        # TODO (correctness) maybe after I/O failure (repeated?) always go back to initial address ? or just remove an entry from the connection when it's invalid, till it's empty ?
+        if not endpoints:
+            endpoints = self._initial_addresses
+        # TODO (correctness) should we pick up randomally, or go each one in the list on each failure ?
+        address = choice(endpoints)
+        pool = self._address_pool(address)
+        self._last_connection = pool
+        # TODO (corectness) on error, try the next one immidiatly
+        conn = await pool.take()
+        self._last_connection_peername = conn.peername()
+        return conn
 
-    async def take_by_key(self, key, **kwargs):
+    async def _address_by_key(self, key, read=False, **kwargs):
         if not isinstance(key, (bytes, bytearray)):
             encode = kwargs.get("encoder", self._settings.get("encoder"))
             key = parse_encoding(encode)(key)
         hashslot = calc_hashslot(key)
-        return await self._connection_by_hashslot(hashslot)
+        return await self._address_by_hashslot(hashslot, read)
+
+    async def take_by_key(self, key, **kwargs):
+        return await self.take(await self._address_by_key(key, **kwargs))
 
     async def take_by_cmd(self, *cmd, **kwargs):
+        return await self.take(await self._address_by_cmd(*cmd, **kwargs))
+
+    # Returns None if any connection can be used
+    async def _address_by_cmd(self, *cmd, **kwargs):
+        read = False
         if is_multiple_commands(*cmd):
             found = False
             # Some commands have no key information (like MULTI) so scan for one which does
@@ -200,21 +361,23 @@ class ClusterConnectionPool:
                 info = await self._get_info_for_command(*command)
                 if info is None:
                     continue
-                index = info[3]
-                if index != 0:
+                if info[3] != 0 or get_command_name(command) in movable_keys:
                     found = True
                     cmd = command
                     break
             if not found:
                 cmd = cmd[0]
+                info = await self._get_info_for_command(*cmd)
         else:
             info = await self._get_info_for_command(*cmd)
+            read = info is not None and b"readonly" in info[2]
         # This should happen only if command doesn't exist
         if info is None:
-            return await self.take()
-        # TODO (misc) maybe see if command is movablekeys, and only do this then, for optimizations
-        index = info[3]
-        if index == 0:
+            return None
+        key = self._first_key(cmd, info)
+        if key is None:
+            return None
+        elif key is False:
             conn = await self.take()
             try:
                 command = [b"COMMAND", b"GETKEYS"]
@@ -224,16 +387,10 @@ class ClusterConnectionPool:
                 key = command_info[0]
             # This happens if the command has no key info, so any connection is good
             except Error:
-                return await self.take()
+                return None
             finally:
                 await self.release(conn)
-        else:
-            # The command does not contain the key, usually this will result in a usage error ?
-            if len(cmd) - 1 < index:
-                return await self.take()
-            else:
-                key = cmd[index]
-        return await self.take_by_key(key, **kwargs)
+        return await self._address_by_key(key, read=read, **kwargs)
 
     async def release(self, conn):
         if self._clustered:
@@ -249,28 +406,50 @@ class ClusterConnectionPool:
             return
         await pool.release(conn)
 
+    def _dropped(self, conn):
+        pool = self._connections.get(conn.peername()) if self._clustered else self._last_connection
+        if pool is not None:
+            pool._dropped(conn)
+
+    def prepare(self, *cmd):
+        return PreparedCommand(*cmd, encoder=self._settings.get("encoder"))
+
     async def __call__(self, *cmd, endpoint=False, **kwargs):
         if not cmd:
             raise ValueError("No command provided")
         if endpoint == "masters":
-            return await self._on_all(*cmd)
+            return await self._on_all(*cmd, **kwargs)
+        if endpoint == False and self._clustered != False and not is_multiple_commands(*cmd) and not kwargs.get("stream") and kwargs.get("into") is None:
+            split = await self._split_by_hashslot(*cmd)
+            if split:
+                return await self._split_command(cmd, *split, **kwargs)
+        if self._auto_pipeline and endpoint == False and can_auto_pipeline(cmd, kwargs):
+            return await self._auto_pipelined(*cmd, **kwargs)
         if self._clustered == False:
             conn = await self.take()
         elif endpoint:
             conn = await self.take(endpoint)
+        elif is_multiple_commands(*cmd):
+            return await self._pipeline(*cmd, **kwargs)
         else:
             conn = await self.take_by_cmd(*cmd)
+        res = None
         try:
-            return await conn(*cmd, **kwargs)
+            res = await conn(*cmd, **kwargs)
+            return res
         except CommunicationError:
-            await self._update_slots()
+            await self._refresh_slots()
             raise
         finally:
             seen_moved = conn.seen_moved()
             seen_asked = conn.seen_asked()
-            await self.release(conn)
+            # A streamed reply keeps the connection until it's consumed
+            if isinstance(res, ReplyStream):
+                res.on_close(partial(self.release, conn), partial(self._dropped, conn))
+            else:
+                await self.release(conn)
             if seen_moved:
-                await self._update_slots()
+                await self._moved(seen_moved)
                 # If the user specified he wants a specific endpoint, we won't force the issue on him.
                 # Also if ths cmd is multiple commands, we won't know which one failed and which didn't, so we don't try as well.
                 if endpoint == False and not is_multiple_commands(*cmd):
@@ -279,6 +458,177 @@ class ClusterConnectionPool:
                 if endpoint == False and not is_multiple_commands(*cmd):
                     return await self(*cmd, **kwargs, endpoint=seen_asked, asking=True)
 
+    # Returns None if the command's keys are in a single hashslot (or it's not a multi key command)
+    async def _split_by_hashslot(self, *cmd):
+        merge = split_commands.get(get_command_name(cmd))
+        if merge is None:
+            return None
+        if self._clustered is None:
+            await self._update_slots()
+            if self._clustered == False:
+                return None
+        info = await self._get_info_for_command(*cmd)
+        if info is None or info[3] == 0:
+            return None
+        first, last, step = info[3], info[4], info[5]
+        if last < 0:
+            last += len(cmd)
+        encode = parse_encoding(self._settings.get("encoder"))
+        hashslots = {}
+        for index in range(first, last + 1, step):
+            key = cmd[index]
+            if not isinstance(key, (bytes, bytearray)):
+                key = encode(key)
+            hashslots.setdefault(calc_hashslot(key), []).append(index)
+        if len(hashslots) < 2:
+            return None
+        return merge, first, step, list(hashslots.values())
+
+    # The command is split to a command per hashslot, which are sent as a pipeline (in parallel per server)
+    async def _split_command(self, cmd, merge, first, step, groups, **kwargs):
+        commands = []
+        for indexes in groups:
+            command = list(cmd[:first])
+            for index in indexes:
+                command.extend(cmd[index : index + step])
+            commands.append(command)
+        try:
+            replies = await self._pipeline(*commands, **kwargs)
+        except PipelinedExceptions as e:
+            for reply in e.args[0]:
+                if isinstance(reply, Exception):
+                    raise reply
+            raise
+        # With attributes=True the replies are wrapped, the merged reply is wrapped the same way (without attributes)
+        wrapped = isinstance(replies[0], Result)
+        if merge == "sum":
+            if wrapped:
+                return Number(sum(reply.data for reply in replies))
+            return sum(replies)
+        elif merge == "first":
+            return replies[0]
+        res = [None] * sum(len(indexes) for indexes in groups)
+        for indexes, reply in zip(groups, replies):
+            if wrapped:
+                reply = reply.data
+            for index, item in zip(indexes, reply):
+                res[(index - first) // step] = item
+        return Array(res) if wrapped else res
+
+    # Returns None for commands without a key that can be found client side (they are sent with the command before them)
+    async def _address_by_command_key(self, *cmd):
+        info = await self._get_info_for_command(*cmd)
+        if info is None:
+            return None
+        key = self._first_key(cmd, info)
+        if key is None or key is False:
+            return None
+        return await self._address_by_key(key)
+
+    # The commands are grouped by the server which has their keys, each server's commands are sent at the same time
+    async def _pipeline(self, *cmds, **kwargs):
+        addresses = []
+        last_address = None
+        for command in cmds:
+            address = await self._address_by_command_key(*command)
+            if address is None:
+                address = last_address
+            elif last_address is None:
+                # The commands before the first command with a key go with it
+                addresses = [address] * len(addresses)
+            addresses.append(address)
+            last_address = address
+        groups = {}
+        for index, address in enumerate(addresses):
+            groups.setdefault(address, []).append(index)
+        if len(groups) == 1:
+            try:
+                res = await self._pipeline_on(last_address, cmds, kwargs, catch_errors=False)
+            except CommunicationError:
+                await self._refresh_slots()
+                raise
+        else:
+            functions = [partial(self._pipeline_on, address, [cmds[index] for index in indexes], kwargs) for address, indexes in groups.items()]
+            res = [None] * len(cmds)
+            for indexes, results in zip(groups.values(), await self._environment.gather(*functions)):
+                for index, result in zip(indexes, results):
+                    res[index] = result
+        found_errors = False
+        updated_slots = False
+        for index, result in enumerate(res):
+            if not isinstance(result, Exception):
+                continue
+            # An invalid command or encoding in one of the groups
+            if isinstance(result, ValueError):
+                raise result
+            if isinstance(result, Error) and result.args[0].startswith(("MOVED ", "ASK ")):
+                # The redirections are retried per command
+                try:
+                    if result.args[0].startswith("ASK "):
+                        _, address = parse_redirection(result.args[0])
+                        res[index] = await self(*cmds[index], **kwargs, endpoint=address, asking=True)
+                    else:
+                        await self._moved(parse_redirection(result.args[0]))
+                        res[index] = await self(*cmds[index], **kwargs)
+                    continue
+                except Exception as e:
+                    res[index] = e
+            elif isinstance(result, CommunicationError) and not updated_slots:
+                await self._refresh_slots()
+                updated_slots = True
+            found_errors = True
+        if found_errors:
+            raise PipelinedExceptions(res)
+        return res
+
+    # Returns the results with the errors in place
+    async def _pipeline_on(self, address, cmds, kwargs, catch_errors=True):
+        try:
+            conn = await self.take(address)
+            try:
+                return await conn(*cmds, **kwargs)
+            finally:
+                # The redirections are retried by the caller
+                conn.seen_moved()
+                conn.seen_asked()
+                await self.release(conn)
+        except PipelinedExceptions as e:
+            return e.args[0]
+        except Exception as e:
+            if not catch_errors:
+                raise
+            return [e] * len(cmds)
+
+    # The command is sent by the auto pipeline of the address's pool, instead of taking a connection for it
+    async def _auto_pipelined(self, *cmd, **kwargs):
+        address = None if self._clustered == False else await self._address_by_cmd(*cmd)
+        if address:
+            pool = self._address_pool(address)
+        else:
+            pool = self._last_connection
+            while pool is None:
+                # This picks up a server for the next times
+                await self.release(await self.take())
+                pool = self._last_connection
+        try:
+            return await pool(*cmd, **kwargs)
+        except CommunicationError:
+            await self._refresh_slots()
+            raise
+        except ConnectionPoolError:
+            # The pool was replaced by a slots update meanwhile
+            if address and pool._closed and not self._closed and self._connections.get(address) is not pool:
+                return await self(*cmd, **kwargs)
+            raise
+        except Error as e:
+            if e.args[0].startswith("MOVED "):
+                await self._moved(parse_redirection(e.args[0]))
+                return await self(*cmd, **kwargs)
+            elif e.args[0].startswith("ASK "):
+                _, address = parse_redirection(e.args[0])
+                return await self(*cmd, **kwargs, endpoint=address, asking=True)
+            raise
+
     @asynccontextmanager
     async def connection(self, key=None, endpoint=None, **kwargs):
         if key and endpoint:
@@ -293,7 +643,7 @@ class ClusterConnectionPool:
             conn.allow_multi(True)
             yield conn
         except CommunicationError:
-            await self._update_slots()
+            await self._refresh_slots()
             raise
         finally:
             # We need to clean up the connection back to a normal state.
@@ -308,31 +658,42 @@ class ClusterConnectionPool:
                 conn.allow_multi(False)
                 await self.release(conn)
                 if seen_moved:
-                    await self._update_slots()
+                    await self._moved(seen_moved)
 
-    async def _on_all(self, *cmd, filter="master", **kwargs):
+    # Returns a dict of address to result (errors are returned as the result), on_reply(address, result) is awaited as each server replies
+    async def _on_all(self, *cmd, filter="master", on_reply=None, **kwargs):
         if self._clustered is None:
             await self._update_slots()
         if self._clustered == False:
+            result = await self(*cmd, **kwargs)
             # This will be always filled by the _update_slots (atleast)
-            return {self._last_connection_peername: await self(*cmd, **kwargs)}
-        # TODO (api) on an error here, raise an exception ?
-        res = {}
-        for address in await self.endpoints():
-            if address[1]["type"] != filter:
-                continue
-            address = address[0]
-            try:
-                res[address] = await self(*cmd, endpoint=address, **kwargs)
-            except Exception as e:
-                res[address] = e
-        return res
+            address = self._last_connection_peername
+            if on_reply is not None:
+                await on_reply(address, result)
+            return {address: result}
+        addresses = [address[0] for address in await self.endpoints() if address[1]["type"] == filter]
+        functions = [partial(self, *cmd, endpoint=address, **kwargs) for address in addresses]
+        results = dict.fromkeys(addresses)
+
+        async def completed(index, result, exception):
+            if exception is not None:
+                result = exception
+            results[addresses[index]] = result
+            if on_reply is not None:
+                await on_reply(addresses[index], result)
+
+        await self._environment.as_completed(functions, completed, self._fanout_limit)
+        return results
+
+    # The connection pools saturation, per server
+    def stats(self):
+        return {address: pool.stats() for address, pool in list(self._connections.items())}
 
     async def endpoints(self):
         if self._clustered is None:
             await self._update_slots()
         if self._clustered:
-            return [(x[1], {"type": "master"}) for x in self._slots.copy()]
+            return [(address, {"type": "master"}) for address in self._slots[0]] + [(address, {"type": "replica"}) for address in self._replica_addresses]
         else:
             # This will be always filled by the _update_slots (atleast)
             return [(self._last_connection_peername, {"type": "regular"})]
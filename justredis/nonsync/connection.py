@@ -1,8 +1,10 @@
+from time import monotonic
+
 from .environment import get_environment
-from ..decoder import RedisRespDecoder, need_more_data, Error
+from ..decoder import create_decoder, need_more_data, Error, StreamHeader, String
 from ..encoder import RedisRespEncoder
 from ..errors import CommunicationError, PipelinedExceptions
-from ..utils import get_command_name, is_multiple_commands
+from ..utils import get_command_name, is_multiple_commands, parse_redirection, blocking_commands
 
 # TODO (correctness) watch for manual SELECT and set_database !
 
@@ -17,23 +19,80 @@ class TimeoutError(Exception):
 timeout_error = TimeoutError()
 
 
+# An iterator over a reply which is read from the connection as it's consumed, the connection can't be used until it's exhausted or closed.
+class ReplyStream:
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._close_callbacks = []
+        self._drop_callbacks = []
+
+    # A stream dropped without being closed can't await here, so the drop callbacks (which must not block) let the owner clean up later
+    def __del__(self):
+        if self._iterator is None:
+            return
+        self._iterator = None
+        callbacks = self._drop_callbacks
+        self._drop_callbacks = []
+        for callback in callbacks:
+            callback()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._iterator is None:
+            raise StopAsyncIteration
+        try:
+            return await self._iterator.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    def on_close(self, callback, drop_callback=None):
+        self._close_callbacks.append(callback)
+        if drop_callback is not None:
+            self._drop_callbacks.append(drop_callback)
+
+    async def aclose(self):
+        if self._iterator is None:
+            return
+        iterator = self._iterator
+        self._iterator = None
+        self._drop_callbacks = []
+        try:
+            await iterator.aclose()
+        finally:
+            callbacks = self._close_callbacks
+            self._close_callbacks = []
+            for callback in callbacks:
+                await callback()
+
+
 class Connection:
     @classmethod
-    async def create(cls, username=None, password=None, client_name=None, resp_version=2, socket_factory="tcp", connect_retry=2, database=0, **kwargs):
+    async def create(cls, username=None, password=None, client_name=None, resp_version=2, socket_factory="tcp", connect_retry=2, database=0, readonly=False, **kwargs):
         ret = cls()
-        await ret._init(username, password, client_name, resp_version, socket_factory, connect_retry, database, **kwargs)
+        await ret._init(username, password, client_name, resp_version, socket_factory, connect_retry, database, readonly, **kwargs)
         return ret
 
     def __init__(self):
         self._socket = None
+        self._io_failed = False
 
     # TODO (api) client_name with connection pool (?)
     # TODO (documentation) the username/password/client_name need the decoding of whatever **kwargs is passed
-    async def _init(self, username=None, password=None, client_name=None, resp_version=2, socket_factory="tcp", connect_retry=2, database=0, **kwargs):
+    async def _init(self, username=None, password=None, client_name=None, resp_version=2, socket_factory="tcp", connect_retry=2, database=0, readonly=False, **kwargs):
         if resp_version not in (-1, 2, 3):
             raise ValueError("Unsupported RESP protocol version %s" % resp_version)
 
-        self._settings = kwargs
+        # The decoder needs to know which protocol it will parse
+        self._settings = dict(kwargs, resp_version=resp_version)
 
         environment = get_environment(**kwargs)
         connect_retry += 1
@@ -46,12 +105,14 @@ class Connection:
                 if not connect_retry:
                     raise CommunicationError() from e
         self._encoder = RedisRespEncoder(**kwargs)
-        self._decoder = RedisRespDecoder(**kwargs)
+        self._decoder = create_decoder(**self._settings)
         self._seen_eof = False
         self._peername = self._socket.peername()
         self._seen_moved = False
         self._seen_ask = False
         self._allow_multi = False
+        self._latency = None
+        self._created = self._last_used = monotonic()
         self._default_database = self._last_database = database
         self._cancel_class = environment.cancelledclass()
 
@@ -88,6 +149,9 @@ class Connection:
                 await self._command(b"CLIENT", b"SETNAME", client_name)
         if database != 0:
             await self._command(b"SELECT", database)
+        # Allows reading from a cluster replica
+        if readonly:
+            await self._command(b"READONLY")
 
     async def aclose(self, force=False):
         if self._socket:
@@ -103,6 +167,14 @@ class Connection:
     def closed(self):
         return self._socket is None
 
+    # Closes the connection because of an I/O error (and not by a caller's decision), the pool counts these as server failures
+    async def _io_error(self):
+        self._io_failed = True
+        await self.aclose(True)
+
+    def io_failed(self):
+        return self._io_failed
+
     def peername(self):
         return self._peername
 
@@ -113,24 +185,24 @@ class Connection:
             else:
                 self._encoder.encode(*cmd)
             while True:
-                data = self._encoder.extract()
-                if data is None:
+                buffers = self._encoder.extract_vector()
+                if buffers is None:
                     break
-                await self._socket.send(data)
+                await self._socket.sendv(buffers)
         except ValueError as e:
             raise
         except self._cancel_class:
             await self.aclose(True)
             raise
         except Exception as e:
-            await self.aclose(True)
+            await self._io_error()
             raise CommunicationError("I/O error while trying to send a command") from e
 
     # TODO (misc) should a decoding error be considered an CommunicationError ?
-    async def _recv(self, timeout=False):
+    async def _recv(self, timeout=False, stream_header=False):
         try:
             while True:
-                res = self._decoder.extract()
+                res = self._decoder.extract_stream_header() if stream_header else self._decoder.extract()
                 if res == need_more_data:
                     if self._seen_eof:
                         await self.aclose()
@@ -152,9 +224,161 @@ class Connection:
             await self.aclose(True)
             raise
         except Exception as e:
+            await self._io_error()
+            raise CommunicationError("Error while trying to read a reply") from e
+
+    # Reads count replies into res, parsing all the replies that are already buffered at once
+    async def _recv_many(self, res, count, timeout=False):
+        try:
+            while True:
+                res.extend(self._decoder.extract_many(count - len(res)))
+                if len(res) == count:
+                    return res
+                if self._seen_eof:
+                    await self.aclose()
+                    raise EOFError("Connection reached EOF")
+                data = await self._socket.recv(timeout)
+                if data == b"":
+                    self._seen_eof = True
+                elif data is None:
+                    raise timeout_error
+                else:
+                    # TODO This check if because another context can close us while we were reading (we can instead simply not remove self._decoder on close)
+                    if not self._decoder:
+                        raise Exception("Connection already closed")
+                    self._decoder.feed(data)
+        except self._cancel_class:
             await self.aclose(True)
+            raise
+        except Exception as e:
+            # A timeout is the caller's decision, not a server failure
+            if e is timeout_error:
+                await self.aclose(True)
+            else:
+                await self._io_error()
             raise CommunicationError("Error while trying to read a reply") from e
 
+    # Reads unparsed data directly from the socket, used for streaming replies
+    async def _recv_raw(self):
+        if self._seen_eof:
+            raise EOFError("Connection reached EOF")
+        data = await self._socket.recv()
+        if data == b"":
+            self._seen_eof = True
+            raise EOFError("Connection reached EOF")
+        elif data is None:
+            raise timeout_error
+        return data
+
+    async def _recv_into(self, view):
+        if self._seen_eof:
+            raise EOFError("Connection reached EOF")
+        nbytes = await self._socket.recv_into(view)
+        if nbytes == 0:
+            self._seen_eof = True
+            raise EOFError("Connection reached EOF")
+        elif nbytes is None:
+            raise timeout_error
+        return nbytes
+
+    async def _skip_raw(self, nbytes):
+        while nbytes:
+            data = self._decoder.extract_raw(nbytes)
+            if not data:
+                data = await self._recv_raw()
+                if len(data) > nbytes:
+                    self._decoder.feed(data[nbytes:])
+                    data = data[:nbytes]
+            nbytes -= len(data)
+
+    # Reads a string reply directly into a writable buffer (such as a bytearray or mmap), returns the string length
+    async def _read_into(self, header, into, orig_decoder):
+        completed = False
+        try:
+            if header.result_type is not String:
+                raise ValueError("Only a string reply can be read into a buffer")
+            length = header.length
+            with memoryview(into) as view:
+                with view.cast("B") as view:
+                    if view.readonly:
+                        raise ValueError("The buffer to read into is not writable")
+                    if length > view.nbytes:
+                        raise ValueError("The reply length (%d) is larger than the buffer to read into (%d)" % (length, view.nbytes))
+                    try:
+                        position = self._decoder.extract_raw_into(view[:length])
+                        while position < length:
+                            position += await self._recv_into(view[position:length])
+                        # The data is followed by \r\n which is not a part of the string
+                        await self._skip_raw(2)
+                    except self._cancel_class:
+                        raise
+                    except Exception as e:
+                        if e is not timeout_error:
+                            await self._io_error()
+                        raise CommunicationError("Error while trying to read a reply") from e
+            completed = True
+            return length
+        finally:
+            await self._finish_stream(completed, orig_decoder)
+
+    async def _stream(self, header, orig_decoder):
+        if header.result_type is String:
+            iterator = self._stream_string(header.length, orig_decoder)
+        else:
+            iterator = self._stream_array(header.length, orig_decoder)
+        # The generators are started here, so closing them even before the first item will still cleanup
+        await iterator.__anext__()
+        return ReplyStream(iterator)
+
+    async def _stream_string(self, length, orig_decoder):
+        completed = False
+        try:
+            yield
+            # The data is followed by \r\n which is not a part of the string
+            total = length + 2
+            position = 0
+            while position < total:
+                data = self._decoder.extract_raw(total - position)
+                if not data:
+                    try:
+                        data = await self._recv_raw()
+                    except self._cancel_class:
+                        raise
+                    except Exception as e:
+                        if e is not timeout_error:
+                            await self._io_error()
+                        raise CommunicationError("Error while trying to read a reply") from e
+                    if len(data) > total - position:
+                        self._decoder.feed(data[total - position :])
+                        data = data[: total - position]
+                chunk = data[: length - position] if position < length else None
+                position += len(data)
+                if chunk:
+                    yield bytes(chunk)
+            completed = True
+        finally:
+            await self._finish_stream(completed, orig_decoder)
+
+    async def _stream_array(self, length, orig_decoder):
+        completed = False
+        try:
+            yield
+            for _ in range(length):
+                res = await self._recv()
+                if res == timeout_error:
+                    raise timeout_error
+                yield res
+            completed = True
+        finally:
+            await self._finish_stream(completed, orig_decoder)
+
+    async def _finish_stream(self, completed, orig_decoder):
+        # If the reply wasn't read completely, the connection is in an unknown state
+        if not completed:
+            await self.aclose(True)
+        elif not self.closed():
+            self._decoder = orig_decoder
+
     async def pushed_message(self, timeout=False, decoder=False, attributes=None):
         orig_decoder = None
         if decoder != False or attributes is not None:
@@ -164,7 +388,7 @@ class Connection:
                 kwargs["decoder"] = decoder
             if attributes is not None:
                 kwargs["attributes"] = attributes
-            self._decoder = RedisRespDecoder(**kwargs)
+            self._decoder = create_decoder(**kwargs)
         try:
             res = await self._recv(timeout)
             if res == timeout_error:
@@ -187,79 +411,125 @@ class Connection:
                 await self._command(b"SELECT", database)
                 self._last_database = database
 
-    async def __call__(self, *cmd, decoder=False, attributes=None, database=None):
+    async def __call__(self, *cmd, decoder=False, attributes=None, database=None, asking=False, stream=False, into=None, timeout=False):
         if not cmd:
             raise ValueError("No command provided")
         orig_decoder = None
-        if decoder != False or attributes is not None:
+        if decoder != False or attributes is not None or stream or into is not None:
             orig_decoder = self._decoder
             kwargs = self._settings.copy()
             if decoder != False:
                 kwargs["decoder"] = decoder
             if attributes is not None:
                 kwargs["attributes"] = attributes
-            self._decoder = RedisRespDecoder(**kwargs)
+            # Streaming replies requires the Python parser
+            if stream or into is not None:
+                kwargs["parser"] = "python"
+            self._decoder = create_decoder(**kwargs)
         try:
             await self.set_database(database)
             if is_multiple_commands(*cmd):
-                return await self._commands(*cmd)
+                if stream or into is not None:
+                    raise ValueError("Streaming a reply is not supported for multiple commands")
+                return await self._commands(*cmd, timeout=timeout)
             else:
-                return await self._command(*cmd)
+                if asking:
+                    await self._command(b"ASKING")
+                if stream or into is not None:
+                    res = await self._command(*cmd, stream=True, timeout=timeout)
+                    if isinstance(res, StreamHeader):
+                        # The stream will restore the decoder when it's done
+                        restore_decoder = orig_decoder
+                        orig_decoder = None
+                        if into is not None:
+                            res = await self._read_into(res, into, restore_decoder)
+                        else:
+                            res = await self._stream(res, restore_decoder)
+                    return res
+                return await self._command(*cmd, timeout=timeout)
         finally:
             if orig_decoder is not None:
                 self._decoder = orig_decoder
 
-    async def _command(self, *cmd):
+    async def _command(self, *cmd, stream=False, timeout=False):
         command_name = get_command_name(cmd)
         if command_name in not_allowed_push_commands:
             raise ValueError("Command %s is not allowed to be called directly, use the appropriate API instead" % cmd)
         if command_name == b"MULTI" and not self._allow_multi:
             raise ValueError("Take a connection if you want to use MULTI command.")
+        start = self._last_used = monotonic()
         await self._send(*cmd)
-        res = await self._recv()
+        res = await self._recv(timeout, stream_header=stream)
+        # Blocking commands wait for data, not for the server
+        if command_name not in blocking_commands:
+            self._latency = monotonic() - start
         if isinstance(res, Error):
             if res.args[0].startswith("MOVED "):
-                self._seen_moved = True
+                self._seen_moved = parse_redirection(res.args[0])
             if res.args[0].startswith("ASK "):
-                _, _, address = res.args[0].split(" ")
-                self._seen_ask = address
+                _, self._seen_ask = parse_redirection(res.args[0])
             raise res
         if res == timeout_error:
             await self.aclose(True)
             raise timeout_error
         return res
 
-    async def _commands(self, *cmds):
+    async def _commands(self, *cmds, timeout=False):
         for cmd in cmds:
             command_name = get_command_name(cmd)
             if command_name in not_allowed_push_commands:
                 raise ValueError("Command %s is not allowed to be called directly, use the appropriate API instead" % cmd)
             if command_name == b"MULTI" and not self._allow_multi:
                 raise ValueError("Take a connection if you want to use MULTI command.")
+        self._last_used = monotonic()
         await self._send(*cmds)
         res = []
         found_errors = False
-        for _ in cmds:
-            try:
-                result = await self._recv()
-                if isinstance(result, Error):
-                    if result.args[0].startswith("MOVED "):
-                        self.seen_moved = True
-                    found_errors = True
-                if result == timeout_error:
-                    await self.aclose(True)
-            except Exception as e:
-                result = e
+        try:
+            await self._recv_many(res, len(cmds), timeout)
+        except Exception as e:
+            res.extend([e] * (len(cmds) - len(res)))
+            found_errors = True
+        for result in res:
+            if isinstance(result, Error):
+                if result.args[0].startswith("MOVED "):
+                    self._seen_moved = parse_redirection(result.args[0])
                 found_errors = True
-            res.append(result)
         if found_errors:
             raise PipelinedExceptions(res)
         return res
 
+    def created(self):
+        return self._created
+
+    def last_used(self):
+        return self._last_used
+
+    # Checks if the connection still works, "peek" checks without blocking that the server did not close it, "ping" sends a PING
+    async def check_health(self, method="peek"):
+        if self.closed():
+            return False
+        try:
+            if method == "ping":
+                await self._command(b"PING")
+            elif not self._socket.alive():
+                await self.aclose()
+                return False
+        except Exception:
+            return False
+        return True
+
+    # Returns the last command round trip time (in seconds) since the last call, or None
+    def latency(self):
+        latency = self._latency
+        self._latency = None
+        return latency
+
     def seen_moved(self):
         if self._seen_moved:
+            ret = self._seen_moved
             self._seen_moved = False
-            return True
+            return ret
         return False
 
     def seen_asked(self):
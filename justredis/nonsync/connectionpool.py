@@ -1,92 +1,521 @@
 from collections import deque
+from functools import partial
+from time import monotonic
+from weakref import ref
 
 try:
     from contextlib import asynccontextmanager
 except:
     from async_generator import asynccontextmanager
 
+# Python 3.6 has no contextvars, so connection affinity is not available there
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
 
-from .connection import Connection
-from ..errors import ConnectionPoolError
+from .connection import Connection, ReplyStream
+from ..errors import CommunicationError, ConnectionPoolError, PipelinedExceptions
 from ..decoder import Error
+from ..encoder import PreparedCommand
+from ..utils import can_auto_pipeline
 from .environment import get_environment
 
 
 # TODO (misc) can we relax the _lock ?
 
 
+class PendingCommand:
+    __slots__ = "cmd", "kwargs", "event", "result", "exception", "done", "leader"
+
+    def __init__(self, cmd, kwargs, event):
+        self.cmd = cmd
+        self.kwargs = kwargs
+        self.event = event
+        self.result = None
+        self.exception = None
+        self.done = False
+        self.leader = False
+
+
+# A caller waiting for a connection when the pool is full, it's handed an idle connection (or None for a free slot to open one)
+class Waiter:
+    __slots__ = "event", "conn", "granted"
+
+    def __init__(self, event):
+        self.event = event
+        self.conn = None
+        self.granted = False
+
+
+# Commands issued concurrently are queued, and sent together as a pipeline on a single connection by one of the callers (the leader).
+# While the leader waits for the replies, new commands are queued up, and the next leader will send them all at once.
+class AutoPipeline:
+    def __init__(self, pool, environment):
+        self._pool = pool
+        self._environment = environment
+        self._lock = environment.lock()
+        self._shield = environment.shield
+        self._cancel_class = environment.cancelledclass()
+        self._queue = deque()
+        self._flushing = False
+
+    async def __call__(self, *cmd, **kwargs):
+        pending = PendingCommand(cmd, kwargs, self._environment.event())
+        async with self._lock:
+            self._queue.append(pending)
+            if not self._flushing:
+                self._flushing = pending.leader = True
+        try:
+            if not pending.leader:
+                await pending.event.wait()
+            # We might have been woken up to be the next leader
+            if not pending.done:
+                await self._flush()
+        except self._cancel_class:
+            async with self._shield():
+                await self._abandon(pending)
+            raise
+        if pending.exception is not None:
+            raise pending.exception
+        return pending.result
+
+    # Must be called with the lock held
+    def _next_leader(self):
+        if self._queue:
+            leader = self._queue[0]
+            leader.leader = True
+            return leader
+        self._flushing = False
+        return None
+
+    # A cancelled command is removed from the queue if it was not sent yet, and makes sure the queue is not left without a leader
+    async def _abandon(self, pending):
+        async with self._lock:
+            try:
+                self._queue.remove(pending)
+            except ValueError:
+                return
+            if not pending.leader:
+                return
+            leader = self._next_leader()
+        if leader is not None:
+            await leader.event.set()
+
+    async def _flush(self):
+        async with self._lock:
+            batch = list(self._queue)
+            self._queue.clear()
+        try:
+            await self._execute(batch)
+        finally:
+            async with self._shield():
+                for pending in batch:
+                    if not pending.done:
+                        pending.exception = CommunicationError("The auto pipeline leader failed while sending the command")
+                        pending.done = True
+                    await pending.event.set()
+                async with self._lock:
+                    leader = self._next_leader()
+                if leader is not None:
+                    await leader.event.set()
+
+    async def _execute(self, batch):
+        try:
+            conn = await self._pool.take()
+        except Exception as e:
+            self._set_exception(batch, e)
+            return
+        try:
+            start = 0
+            # Commands with different settings are sent as seperate pipelines on the same connection
+            while start < len(batch):
+                kwargs = batch[start].kwargs
+                end = start + 1
+                while end < len(batch) and batch[end].kwargs == kwargs:
+                    end += 1
+                run = batch[start:end]
+                try:
+                    await self._execute_run(conn, run, kwargs)
+                except self._cancel_class:
+                    raise
+                except Exception as e:
+                    # The connection is not usable anymore, the replies which were already read are kept
+                    self._set_exception([pending for pending in batch[start:] if not pending.done], e)
+                    return
+                start = end
+        finally:
+            # The redirections are handled by each command's caller
+            conn.seen_moved()
+            conn.seen_asked()
+            await self._pool.release(conn)
+
+    # Sets the result of each command in the run
+    async def _execute_run(self, conn, run, kwargs):
+        try:
+            results = await conn(*[pending.cmd for pending in run], **kwargs)
+        except PipelinedExceptions as e:
+            results = e.args[0]
+        except ValueError:
+            # Nothing was sent (invalid command or encoding), so find out which one failed
+            results = None
+        if results is not None:
+            for pending, result in zip(run, results):
+                self._set_result(pending, result)
+            return
+        for pending in run:
+            try:
+                result = await conn(*pending.cmd, **kwargs)
+            except (Error, ValueError) as e:
+                result = e
+            self._set_result(pending, result)
+
+    def _set_result(self, pending, result):
+        if isinstance(result, Exception):
+            pending.exception = result
+        else:
+            pending.result = result
+        pending.done = True
+
+    def _set_exception(self, batch, exception):
+        for pending in batch:
+            pending.exception = exception
+            pending.done = True
+
+
 class ConnectionPool:
-    def __init__(self, max_connections=None, wait_timeout=None, **kwargs):
+    def __init__(self, max_connections=None, wait_timeout=None, auto_pipeline=False, eject_errors=3, eject_timeout=10, min_connections=0, prewarm=False, idle_timeout=None, max_connection_age=None, health_check=None, pool_order="fifo", connection_affinity=False, max_waiters=None, **kwargs):
+        if pool_order not in ("fifo", "lifo"):
+            raise ValueError("Unsupported pool_order %s" % pool_order)
+        if connection_affinity and ContextVar is None:
+            raise ValueError("connection_affinity requires Python 3.7 or later in async mode")
         self._max_connections = max_connections
         self._wait_timeout = wait_timeout
+        self._min_connections = min_connections
+        self._idle_timeout = idle_timeout
+        self._max_connection_age = max_connection_age
+        self._health_check = health_check
+        self._prewarm = prewarm and min_connections
+        # How many idle connections are being opened
+        self._opening = 0
+        # The server's health, used by the cluster to pick a server
+        self._latency = None
+        self._errors = 0
+        self._eject_errors = eject_errors
+        self._eject_timeout = eject_timeout
+        self._ejected_until = 0
+        # Waiting for a connection when the pool is full
+        self._max_waiters = max_waiters
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+        self._rejected = 0
         self._connection_settings = kwargs
+        self._environment = get_environment(**kwargs)
+        self._auto_pipeline = AutoPipeline(self, get_environment(**kwargs)) if auto_pipeline else None
 
         self._lock = get_environment(**kwargs).lock()
         self._shield = get_environment(**kwargs).shield
+        self._gather = get_environment(**kwargs).gather
         self._limit = get_environment(**kwargs).semaphore(max_connections) if max_connections else None
         self._connections_available = deque()
+        # LIFO keeps using the same (hot) connections, and lets the rest expire
+        self._pop = self._connections_available.pop if pool_order == "lifo" else self._connections_available.popleft
+        # Remembers the last connection each task used, to prefer it when it's idle
+        self._affinity = ContextVar("justredis_connection_affinity", default=None) if connection_affinity else None
         self._connections_in_use = set()
+        # The connections of dropped streams, they are closed on the next take or release
+        self._dropped_connections = deque()
+        # The callers waiting for a connection, in the order they started waiting
+        self._waiters = deque()
         self._closed = False
 
     async def aclose(self):
         async with self._lock:
             if not self._closed:
                 # We do this first, so if another thread calls release it won't get back to the pool
-                for connection in self._connections_available:
+                for connection in list(self._connections_available):
+                    await connection.aclose()
+                for connection in list(self._connections_in_use):
                     await connection.aclose()
-                for connection in self._connections_in_use:
+                for connection in list(self._dropped_connections):
                     await connection.aclose()
                 self._connections_available.clear()
                 self._connections_in_use.clear()
-                self._limit = get_environment(**self.connection_settings).semaphore(self._max_connections) if self._max_connections else None
+                self._dropped_connections.clear()
+                self._limit = get_environment(**self._connection_settings).semaphore(self._max_connections) if self._max_connections else None
             self._closed = True
+            # The waiters will find out the pool is closed
+            for waiter in list(self._waiters):
+                await waiter.event.set()
 
     async def take(self):
         if self._closed:
             raise ConnectionPoolError("Pool already closed")
+        if self._dropped_connections:
+            await self._close_dropped()
+        if self._prewarm:
+            await self.prewarm()
         # TODO (correctness) cluster depends on this failing if closed !
+        conn = await self._affine_connection() if self._affinity is not None else None
+        if conn is None:
+            conn = await self._idle_connection()
+            if conn is None:
+                # There is no background task here, so the idle connections are opened at the same time as this one
+                if self._min_connections and not self._opening:
+                    conn = (await self._gather(self._create, self._fill))[0]
+                else:
+                    conn = await self._create()
+            if self._affinity is not None:
+                self._affinity.set(ref(conn))
+        self._connections_in_use.add(conn)
+        return conn
+
+    # Returns the connection this task used last time, if it's idle
+    async def _affine_connection(self):
+        # Like the other idle connections, it goes to the waiters first
+        if self._waiters:
+            return None
+        conn = self._affinity.get()
+        conn = conn() if conn is not None else None
+        if conn is None:
+            return None
+        try:
+            self._connections_available.remove(conn)
+        except ValueError:
+            return None
+        if not conn.closed() and await self._usable(conn):
+            return conn
+        await conn.aclose()
+        await self._release_limit()
+        return None
+
+    async def _idle_connection(self):
+        # The idle connections go to the waiters first, so new callers can't get ahead of them
+        if self._waiters:
+            return None
         try:
             while True:
-                conn = self._connections_available.popleft()
-                if not conn.closed():
-                    break
-                if self._limit is not None:
-                    await self._limit.release()
+                conn = self._pop()
+                if not conn.closed() and await self._usable(conn):
+                    return conn
+                await conn.aclose()
+                await self._release_limit()
         except IndexError:
-            if self._limit is not None and not await self._limit.acquire(self._wait_timeout):
-                raise ConnectionPoolError("Could not acquire an connection form the pool")
+            return None
+
+    def _expired(self, conn, now):
+        if self._max_connection_age is not None and now - conn.created() >= self._max_connection_age:
+            return True
+        return self._idle_timeout is not None and now - conn.last_used() >= self._idle_timeout
+
+    # Checks an idle connection before it's used (there is no background task to do it in async mode)
+    async def _usable(self, conn):
+        if (self._idle_timeout is not None or self._max_connection_age is not None) and self._expired(conn, monotonic()):
+            return False
+        return self._health_check is None or await conn.check_health(self._health_check)
+
+    async def _create(self):
+        if self._limit is not None and (self._waiters or not await self._limit.acquire(0)):
+            conn = await self._wait()
+            if conn is not None:
+                return conn
+        try:
+            return await Connection.create(**self._connection_settings)
+        except Exception:
+            await self._release_limit()
+            self._failed()
+            raise
+
+    # Waits in line (up to wait_timeout) for a connection to be released, returns it or None if a free slot to open one was handed instead
+    async def _wait(self):
+        if self._max_waiters is not None and len(self._waiters) >= self._max_waiters:
+            self._rejected += 1
+            raise ConnectionPoolError("Too many callers are waiting for a connection from the pool")
+        waiter = Waiter(self._environment.event())
+        start = monotonic()
+        self._waiters.append(waiter)
+        # A connection might have been released before we got in line
+        await self._wake()
+        finished = False
+        try:
+            await waiter.event.wait(self._wait_timeout)
+            finished = True
+        finally:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+            elif not finished:
+                # We were cancelled after being handed a connection (or a slot), so pass it on
+                async with self._shield():
+                    if waiter.conn is not None:
+                        self._connections_available.append(waiter.conn)
+                        await self._wake()
+                    else:
+                        await self._release_limit()
+        waited = monotonic() - start
+        self._waits += 1
+        self._wait_time += waited
+        self._max_wait_time = max(self._max_wait_time, waited)
+        if not waiter.granted:
+            if self._closed:
+                raise ConnectionPoolError("Pool already closed")
+            self._timeouts += 1
+            raise ConnectionPoolError("Could not acquire an connection form the pool")
+        conn = waiter.conn
+        # We keep the slot of a bad connection, and open a new one instead
+        if conn is not None and (conn.closed() or not await self._usable(conn)):
+            await conn.aclose()
+            conn = None
+        return conn
+
+    # Hands the idle connections and free slots to the waiters, in the order they started waiting
+    async def _wake(self):
+        while self._waiters:
             try:
-                conn = await Connection.create(**self._connection_settings)
-            except Exception:
-                if self._limit is not None:
+                conn = self._pop()
+            except IndexError:
+                if not await self._limit.acquire(0):
+                    break
+                conn = None
+                if not self._waiters:
                     await self._limit.release()
-                raise
-        self._connections_in_use.add(conn)
-        return conn
+                    break
+            waiter = self._waiters.popleft()
+            waiter.conn = conn
+            waiter.granted = True
+            await waiter.event.set()
+
+    async def _release_limit(self):
+        if self._limit is not None:
+            await self._limit.release()
+            if self._waiters:
+                await self._wake()
+
+    # Opens min_connections connections now
+    async def prewarm(self):
+        self._prewarm = False
+        await self._fill()
+
+    async def _fill(self):
+        # The connections other calls are still opening count as well, so concurrent calls don't open min_connections each
+        missing = self._min_connections - len(self._connections_available) - self._opening
+        if self._max_connections:
+            missing = min(missing, self._max_connections - len(self._connections_available) - len(self._connections_in_use) - self._opening - 1)
+        if missing > 0:
+            self._opening += missing
+            try:
+                await self._gather(*[self._open_idle] * missing)
+            finally:
+                self._opening -= missing
+
+    async def _open_idle(self):
+        if self._limit is not None and (self._waiters or not await self._limit.acquire(0)):
+            return
+        try:
+            conn = await Connection.create(**self._connection_settings)
+        except Exception:
+            await self._release_limit()
+            self._failed()
+            return
+        self._connections_available.append(conn)
+        # The pool might have been closed meanwhile
+        if self._closed:
+            await conn.aclose()
+        elif self._waiters:
+            await self._wake()
 
     async def release(self, conn):
+        # Only I/O errors count, a connection closed by the caller (such as a stream not read completely, or a timeout) says nothing about the server
+        if conn.io_failed():
+            self._failed()
+        elif not conn.closed():
+            self._errors = 0
+            latency = conn.latency()
+            if latency is not None:
+                self._latency = latency if self._latency is None else self._latency * 0.8 + latency * 0.2
+        # The set and deque operations are done without awaiting, so there is no need for the lock here
         async with self._shield():
-            async with self._lock:
-                try:
-                    self._connections_in_use.remove(conn)
-                # TODO (correctness) should we release the self._limit here as well ? (or just make close forever)
-                # If this fails, it's a connection from a previous cycle, don't reuse it
-                except KeyError:
+            try:
+                self._connections_in_use.remove(conn)
+            # TODO (correctness) should we release the self._limit here as well ? (or just make close forever)
+            # If this fails, it's a connection from a previous cycle, don't reuse it
+            except KeyError:
+                await conn.aclose()
+                return
+            if not conn.closed():
+                self._connections_available.append(conn)
+                # The pool might have been closed meanwhile
+                if self._closed:
                     await conn.aclose()
-                    return
-                if not conn.closed():
-                    self._connections_available.append(conn)
-                elif self._limit is not None:
-                    await self._limit.release()
+                elif self._waiters:
+                    await self._wake()
+            else:
+                await self._release_limit()
+            if self._dropped_connections:
+                await self._close_dropped()
+
+    # The connection of a stream which was dropped without being closed, it's in an unknown state so it's not reused
+    def _dropped(self, conn):
+        try:
+            self._connections_in_use.remove(conn)
+        except KeyError:
+            return
+        self._dropped_connections.append(conn)
+
+    async def _close_dropped(self):
+        while self._dropped_connections:
+            conn = self._dropped_connections.popleft()
+            await conn.aclose(True)
+            await self._release_limit()
+
+    def _failed(self):
+        self._errors += 1
+        if self._errors >= self._eject_errors:
+            self._ejected_until = monotonic() + self._eject_timeout
+
+    # Returns the moving average of the commands latency (in seconds), or None if not measured yet
+    def latency(self):
+        return self._latency
+
+    # A server which keeps failing is ejected for eject_timeout seconds, afterwards it can be tried again
+    def healthy(self):
+        return self._errors < self._eject_errors or monotonic() >= self._ejected_until
+
+    # The pool saturation, the wait times are in seconds
+    def stats(self):
+        return {
+            "in_use": len(self._connections_in_use),
+            "idle": len(self._connections_available),
+            "waiting": len(self._waiters),
+            "waits": self._waits,
+            "wait_time": self._wait_time,
+            "max_wait_time": self._max_wait_time,
+            "timeouts": self._timeouts,
+            "rejected": self._rejected,
+            "errors": self._errors,
+        }
+
+    def prepare(self, *cmd):
+        return PreparedCommand(*cmd, encoder=self._connection_settings.get("encoder"))
 
     async def __call__(self, *cmd, **kwargs):
         if not cmd:
             raise ValueError("No command provided")
+        if self._auto_pipeline is not None and can_auto_pipeline(cmd, kwargs):
+            return await self._auto_pipeline(*cmd, **kwargs)
         conn = await self.take()
+        res = None
         try:
-            return await conn(*cmd, **kwargs)
+            res = await conn(*cmd, **kwargs)
+            return res
         finally:
-            await self.release(conn)
+            # A streamed reply keeps the connection until it's consumed
+            if isinstance(res, ReplyStream):
+                res.on_close(partial(self.release, conn), partial(self._dropped, conn))
+            else:
+                await self.release(conn)
 
     @asynccontextmanager
     async def connection(self, **kwargs):
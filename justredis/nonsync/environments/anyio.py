@@ -4,6 +4,7 @@ try:
     anyio.create_tcp_listener
 except AttributeError:
     raise AttributeError("You are using an old and incompatible AnyIO version, the minimum required version is AnyIO 2.0.0 .")
+from collections import deque
 import socket
 import sys
 import ssl
@@ -75,6 +76,7 @@ class SocketWrapper:
     async def _init(self, socket_factory, buffersize=2 ** 16, socket_timeout=None, **kwargs):
         self._buffersize = buffersize
         self._socket_timeout = socket_timeout
+        self._tls = socket_factory is sslsocket
         self._socket = await socket_factory(**kwargs)
 
     async def aclose(self, force=False):
@@ -90,6 +92,16 @@ class SocketWrapper:
         else:
             await self._socket.send(data)
 
+    # AnyIO streams have no vectored send, so each buffer is sent on it's own (runs of small chunks are already coalesced by the encoder)
+    async def sendv(self, buffers):
+        if self._socket_timeout:
+            async with anyio.fail_after(self._socket_timeout):
+                for buffer in buffers:
+                    await self._socket.send(buffer)
+        else:
+            for buffer in buffers:
+                await self._socket.send(buffer)
+
     # If you override this, make sure to return an empty bytes for EOF and a None for timeout !
     async def recv(self, timeout=False):
         if timeout is False:
@@ -103,6 +115,36 @@ class SocketWrapper:
         else:
             return await self._socket.receive(self._buffersize)
 
+    # AnyIO streams have no readinto support, so the data is copied from the received chunk
+    async def recv_into(self, view):
+        max_bytes = min(self._buffersize, len(view))
+        if self._socket_timeout:
+            try:
+                async with anyio.fail_after(self._socket_timeout):
+                    data = await self._socket.receive(max_bytes)
+            except TimeoutError:
+                return None
+        else:
+            data = await self._socket.receive(max_bytes)
+        view[: len(data)] = data
+        return len(data)
+
+    # Checks without blocking that the server did not close the connection (or sent unexpected data)
+    def alive(self):
+        # The raw socket of a TLS stream might have pending TLS records (such as session tickets), so there is no way to know
+        if self._tls:
+            return True
+        raw_socket = self._socket.extra(anyio.abc.SocketAttribute.raw_socket, None)
+        if raw_socket is None or not hasattr(socket, "MSG_DONTWAIT"):
+            return True
+        try:
+            raw_socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+
     def peername(self):
         peername = self._socket.extra(anyio.abc.SocketAttribute.remote_address)
         if isinstance(peername, (list, tuple)):
@@ -110,19 +152,62 @@ class SocketWrapper:
         return peername
 
 
+# A plain counter, an AnyIO capacity limiter tracks which task borrowed each token, but the pool hands them between tasks
 class OurSemaphore:
     def __init__(self, value):
-        self._semaphore = anyio.create_capcity_limiter(value)
+        self._value = value
+        # The [event, granted] of the tasks waiting, in the order they started waiting
+        self._waiters = deque()
 
     async def release(self):
-        await self._semaphore.release()
+        if self._waiters:
+            waiter = self._waiters.popleft()
+            waiter[1] = True
+            await waiter[0].set()
+        else:
+            self._value += 1
 
     async def acquire(self, timeout=None):
-        if timeout:
-            async with anyio.fail_after(timeout):
-                await self._semaphore.acquire()
-        else:
-            await self._semaphore.acquire()
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return True
+        if timeout == 0:
+            return False
+        waiter = [anyio.create_event(), False]
+        self._waiters.append(waiter)
+        try:
+            if timeout:
+                async with anyio.move_on_after(timeout):
+                    await waiter[0].wait()
+            else:
+                await waiter[0].wait()
+        except BaseException:
+            # We were cancelled after being handed a token, so pass it on
+            if waiter[1]:
+                async with anyio.open_cancel_scope(shield=True):
+                    await self.release()
+            raise
+        finally:
+            if not waiter[1]:
+                self._waiters.remove(waiter)
+        return waiter[1]
+
+
+class OurEvent:
+    def __init__(self):
+        self._event = anyio.create_event()
+
+    async def set(self):
+        await self._event.set()
+
+    async def wait(self, timeout=None):
+        if timeout is None:
+            await self._event.wait()
+            return True
+        async with anyio.move_on_after(timeout):
+            await self._event.wait()
+            return True
+        return False
 
 
 class AnyIOEnvironment:
@@ -146,6 +231,42 @@ class AnyIOEnvironment:
     def lock():
         return anyio.create_lock()
 
+    @staticmethod
+    def event():
+        return OurEvent()
+
+    # Runs the functions concurrently and returns their results
+    @staticmethod
+    async def gather(*functions):
+        results = [None] * len(functions)
+
+        async def run(index, function):
+            results[index] = await function()
+
+        async with anyio.create_task_group() as task_group:
+            for index, function in enumerate(functions):
+                await task_group.spawn(run, index, function)
+        return results
+
+    # Runs the functions concurrently with at most limit tasks, and awaits callback(index, result, exception) as each one finishes
+    # (it's not a generator, since yielding from inside a task group is unsafe)
+    @staticmethod
+    async def as_completed(functions, callback, limit=None):
+        indexes = iter(range(len(functions)))
+
+        async def worker():
+            for index in indexes:
+                try:
+                    result = await functions[index]()
+                except Exception as e:
+                    await callback(index, None, e)
+                else:
+                    await callback(index, result, None)
+
+        async with anyio.create_task_group() as task_group:
+            for _ in range(min(limit or len(functions), len(functions))):
+                await task_group.spawn(worker)
+
     # async only?
     @staticmethod
     def shield():
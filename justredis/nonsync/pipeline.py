@@ -0,0 +1,101 @@
+from ..errors import PipelinedExceptions
+from ..utils import command_size
+
+
+class PipelineResult:
+    __slots__ = "_value", "_done"
+
+    def __init__(self):
+        self._value = None
+        self._done = False
+
+    def done(self):
+        return self._done
+
+    # Raises the command's error if it failed
+    def result(self):
+        if not self._done:
+            raise ValueError("The pipeline was not flushed yet")
+        if isinstance(self._value, Exception):
+            raise self._value
+        return self._value
+
+    def _set(self, value):
+        self._value = value
+        self._done = True
+
+
+# Queues commands and sends them together every max_commands commands or max_bytes (estimated) bytes
+class Pipeline:
+    def __init__(self, redis, max_commands=1000, max_bytes=2 ** 20, **kwargs):
+        if max_commands < 1:
+            raise ValueError("max_commands must be at least 1")
+        self._redis = redis
+        self._max_commands = max_commands
+        self._max_bytes = max_bytes
+        self._settings = kwargs
+        self._commands = []
+        self._results = []
+        self._size = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.flush()
+        else:
+            self._commands = []
+            self._results = []
+            self._size = 0
+
+    async def __call__(self, *cmd):
+        if not cmd:
+            raise ValueError("No command provided")
+        result = PipelineResult()
+        self._commands.append(cmd)
+        self._results.append(result)
+        self._size += command_size(cmd)
+        if len(self._commands) >= self._max_commands or self._size >= self._max_bytes:
+            await self.flush()
+        return result
+
+    async def flush(self):
+        if not self._commands:
+            return
+        commands = self._commands
+        results = self._results
+        self._commands = []
+        self._results = []
+        self._size = 0
+        try:
+            replies = await self._send(commands)
+        except Exception as e:
+            for result in results:
+                result._set(e)
+            raise
+        for result, reply in zip(results, replies):
+            result._set(reply)
+
+    # Sends the commands from the iterable in chunks, and yields each reply as it's chunk is done (errors are yielded in place)
+    async def execute(self, commands):
+        await self.flush()
+        chunk = []
+        size = 0
+        for cmd in commands:
+            chunk.append(cmd)
+            size += command_size(cmd)
+            if len(chunk) >= self._max_commands or size >= self._max_bytes:
+                for reply in await self._send(chunk):
+                    yield reply
+                chunk = []
+                size = 0
+        if chunk:
+            for reply in await self._send(chunk):
+                yield reply
+
+    async def _send(self, commands):
+        try:
+            return await self._redis(*commands, **self._settings)
+        except PipelinedExceptions as e:
+            return e.args[0]
@@ -1,5 +1,6 @@
 from .connectionpool import ConnectionPool
 from .cluster import ClusterConnectionPool
+from .pipeline import Pipeline
 from ..decoder import Error
 from ..utils import parse_url, merge_dicts
 
@@ -42,6 +43,18 @@ class ModifiedRedis:
     async def endpoints(self):
         return await self._connection_pool.endpoints()
 
+    # The connection pool saturation (per server in a cluster), see the connection pool settings
+    def pool_stats(self):
+        return self._connection_pool.stats()
+
+    # kwargs options = max_commands, max_bytes and the per call settings
+    def pipeline(self, **kwargs):
+        return Pipeline(self, **kwargs)
+
+    # The None arguments are filled with bind(), which returns a regular command (that can be used in a pipeline as well)
+    def prepare(self, *cmd):
+        return self._connection_pool.prepare(*cmd)
+
     def modify(self, **kwargs):
         settings = self._settings.copy()
         settings.update(kwargs)
@@ -102,6 +115,9 @@ class ModifiedConnection:
         else:
             return await self._connection(*cmd, **settings)
 
+    def pipeline(self, **kwargs):
+        return Pipeline(self, **kwargs)
+
     def modify(self, **kwargs):
         settings = self._settings.copy()
         settings.update(kwargs)
@@ -1,8 +1,10 @@
+from time import monotonic
+
 from .environment import get_environment
-from ..decoder import RedisRespDecoder, need_more_data, Error
+from ..decoder import create_decoder, need_more_data, Error, StreamHeader, String
 from ..encoder import RedisRespEncoder
 from ..errors import CommunicationError, PipelinedExceptions
-from ..utils import get_command_name, is_multiple_commands
+from ..utils import get_command_name, is_multiple_commands, parse_redirection, blocking_commands
 
 
 # TODO (correctness) watch for manual SELECT and set_database !
@@ -18,19 +20,64 @@ class TimeoutError(Exception):
 timeout_error = TimeoutError()
 
 
+# An iterator over a reply which is read from the connection as it's consumed, the connection can't be used until it's exhausted or closed.
+class ReplyStream:
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._close_callbacks = []
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            raise StopIteration
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def on_close(self, callback):
+        self._close_callbacks.append(callback)
+
+    def close(self):
+        if self._iterator is None:
+            return
+        iterator = self._iterator
+        self._iterator = None
+        try:
+            iterator.close()
+        finally:
+            callbacks = self._close_callbacks
+            self._close_callbacks = []
+            for callback in callbacks:
+                callback()
+
+
 class Connection:
     @classmethod
-    def create(cls, username=None, password=None, client_name=None, resp_version=2, socket_factory="tcp", connect_retry=2, database=0, **kwargs):
+    def create(cls, username=None, password=None, client_name=None, resp_version=2, socket_factory="tcp", connect_retry=2, database=0, readonly=False, **kwargs):
         ret = cls()
-        ret._init(username, password, client_name, resp_version, socket_factory, connect_retry, database, **kwargs)
+        ret._init(username, password, client_name, resp_version, socket_factory, connect_retry, database, readonly, **kwargs)
         return ret
 
     def __init__(self):
         self._socket = None
+        self._io_failed = False
 
     # TODO (api) client_name with connection pool (?)
     # TODO (documentation) the username/password/client_name need the decoding of whatever **kwargs is passed
-    def _init(self, username=None, password=None, client_name=None, resp_version=2, socket_factory="tcp", connect_retry=2, database=0, **kwargs):
+    def _init(self, username=None, password=None, client_name=None, resp_version=2, socket_factory="tcp", connect_retry=2, database=0, readonly=False, **kwargs):
         resp_version = int(resp_version)
         connect_retry = int(connect_retry)
         database = int(database)
@@ -38,7 +85,8 @@ class Connection:
         if resp_version not in (-1, 2, 3):
             raise ValueError("Unsupported RESP protocol version %s" % resp_version)
 
-        self._settings = kwargs
+        # The decoder needs to know which protocol it will parse
+        self._settings = dict(kwargs, resp_version=resp_version)
 
         environment = get_environment(**kwargs)
         connect_retry += 1
@@ -51,12 +99,14 @@ class Connection:
                 if not connect_retry:
                     raise CommunicationError() from e
         self._encoder = RedisRespEncoder(**kwargs)
-        self._decoder = RedisRespDecoder(**kwargs)
+        self._decoder = create_decoder(**self._settings)
         self._seen_eof = False
         self._peername = self._socket.peername()
         self._seen_moved = False
         self._seen_ask = False
         self._allow_multi = False
+        self._latency = None
+        self._created = self._last_used = monotonic()
         self._default_database = self._last_database = database
 
         connected = False
@@ -92,6 +142,9 @@ class Connection:
                 self._command(b"CLIENT", b"SETNAME", client_name)
         if database != 0:
             self._command(b"SELECT", database)
+        # Allows reading from a cluster replica
+        if readonly:
+            self._command(b"READONLY")
 
     def __del__(self):
         self.close()
@@ -110,6 +163,14 @@ class Connection:
     def closed(self):
         return self._socket is None
 
+    # Closes the connection because of an I/O error (and not by a caller's decision), the pool counts these as server failures
+    def _io_error(self):
+        self._io_failed = True
+        self.close()
+
+    def io_failed(self):
+        return self._io_failed
+
     def peername(self):
         return self._peername
 
@@ -120,24 +181,24 @@ class Connection:
             else:
                 self._encoder.encode(*cmd)
             while True:
-                data = self._encoder.extract()
-                if data is None:
+                buffers = self._encoder.extract_vector()
+                if buffers is None:
                     break
-                self._socket.send(data)
+                self._socket.sendv(buffers)
         except ValueError as e:
             raise
         except Exception as e:
-            self.close()
+            self._io_error()
             raise CommunicationError("I/O error while trying to send a command") from e
         except BaseException:
             self.close()
             raise
 
     # TODO (misc) should a decoding error be considered an CommunicationError ?
-    def _recv(self, timeout=False):
+    def _recv(self, timeout=False, stream_header=False):
         try:
             while True:
-                res = self._decoder.extract()
+                res = self._decoder.extract_stream_header() if stream_header else self._decoder.extract()
                 if res == need_more_data:
                     if self._seen_eof:
                         self.close()
@@ -156,12 +217,160 @@ class Connection:
                     continue
                 return res
         except Exception as e:
+            self._io_error()
+            raise CommunicationError("Error while trying to read a reply") from e
+        except BaseException:
             self.close()
+            raise
+
+    # Reads count replies into res, parsing all the replies that are already buffered at once
+    def _recv_many(self, res, count, timeout=False):
+        try:
+            while True:
+                res.extend(self._decoder.extract_many(count - len(res)))
+                if len(res) == count:
+                    return res
+                if self._seen_eof:
+                    self.close()
+                    raise EOFError("Connection reached EOF")
+                data = self._socket.recv(timeout)
+                if data == b"":
+                    self._seen_eof = True
+                elif data is None:
+                    raise timeout_error
+                else:
+                    # TODO This check if because another context can close us while we were reading (we can instead simply not remove self._decoder on close)
+                    if not self._decoder:
+                        raise Exception("Connection already closed")
+                    self._decoder.feed(data)
+        except Exception as e:
+            # A timeout is the caller's decision, not a server failure
+            if e is timeout_error:
+                self.close()
+            else:
+                self._io_error()
             raise CommunicationError("Error while trying to read a reply") from e
         except BaseException:
             self.close()
             raise
 
+    # Reads unparsed data directly from the socket, used for streaming replies
+    def _recv_raw(self):
+        if self._seen_eof:
+            raise EOFError("Connection reached EOF")
+        data = self._socket.recv()
+        if data == b"":
+            self._seen_eof = True
+            raise EOFError("Connection reached EOF")
+        elif data is None:
+            raise timeout_error
+        return data
+
+    def _recv_into(self, view):
+        if self._seen_eof:
+            raise EOFError("Connection reached EOF")
+        nbytes = self._socket.recv_into(view)
+        if nbytes == 0:
+            self._seen_eof = True
+            raise EOFError("Connection reached EOF")
+        elif nbytes is None:
+            raise timeout_error
+        return nbytes
+
+    def _skip_raw(self, nbytes):
+        while nbytes:
+            data = self._decoder.extract_raw(nbytes)
+            if not data:
+                data = self._recv_raw()
+                if len(data) > nbytes:
+                    self._decoder.feed(data[nbytes:])
+                    data = data[:nbytes]
+            nbytes -= len(data)
+
+    # Reads a string reply directly into a writable buffer (such as a bytearray or mmap), returns the string length
+    def _read_into(self, header, into, orig_decoder):
+        completed = False
+        try:
+            if header.result_type is not String:
+                raise ValueError("Only a string reply can be read into a buffer")
+            length = header.length
+            with memoryview(into) as view:
+                with view.cast("B") as view:
+                    if view.readonly:
+                        raise ValueError("The buffer to read into is not writable")
+                    if length > view.nbytes:
+                        raise ValueError("The reply length (%d) is larger than the buffer to read into (%d)" % (length, view.nbytes))
+                    try:
+                        position = self._decoder.extract_raw_into(view[:length])
+                        while position < length:
+                            position += self._recv_into(view[position:length])
+                        # The data is followed by \r\n which is not a part of the string
+                        self._skip_raw(2)
+                    except Exception as e:
+                        if e is not timeout_error:
+                            self._io_error()
+                        raise CommunicationError("Error while trying to read a reply") from e
+            completed = True
+            return length
+        finally:
+            self._finish_stream(completed, orig_decoder)
+
+    def _stream(self, header, orig_decoder):
+        if header.result_type is String:
+            iterator = self._stream_string(header.length, orig_decoder)
+        else:
+            iterator = self._stream_array(header.length, orig_decoder)
+        # The generators are started here, so closing them even before the first item will still cleanup
+        next(iterator)
+        return ReplyStream(iterator)
+
+    def _stream_string(self, length, orig_decoder):
+        completed = False
+        try:
+            yield
+            # The data is followed by \r\n which is not a part of the string
+            total = length + 2
+            position = 0
+            while position < total:
+                data = self._decoder.extract_raw(total - position)
+                if not data:
+                    try:
+                        data = self._recv_raw()
+                    except Exception as e:
+                        if e is not timeout_error:
+                            self._io_error()
+                        raise CommunicationError("Error while trying to read a reply") from e
+                    if len(data) > total - position:
+                        self._decoder.feed(data[total - position :])
+                        data = data[: total - position]
+                chunk = data[: length - position] if position < length else None
+                position += len(data)
+                if chunk:
+                    yield bytes(chunk)
+            completed = True
+        finally:
+            self._finish_stream(completed, orig_decoder)
+
+    def _stream_array(self, length, orig_decoder):
+        completed = False
+        try:
+            yield
+            for _ in range(length):
+                res = self._recv()
+                if res == timeout_error:
+                    raise timeout_error
+                yield res
+            completed = True
+        finally:
+            self._finish_stream(completed, orig_decoder)
+
+    def _finish_stream(self, completed, orig_decoder):
+        # If the reply wasn't read completely, the connection is in an unknown state
+        if not completed:
+            self.close()
+        elif not self.closed():
+            self._decoder = orig_decoder
+
     def pushed_message(self, timeout=False, decoder=False, attributes=None):
         orig_decoder = None
         if decoder != False or attributes is not None:
@@ -171,7 +380,7 @@ class Connection:
                 kwargs["decoder"] = decoder
             if attributes is not None:
                 kwargs["attributes"] = attributes
-            self._decoder = RedisRespDecoder(**kwargs)
+            self._decoder = create_decoder(**kwargs)
         try:
             res = self._recv(timeout)
             if res == timeout_error:
@@ -194,81 +403,125 @@ class Connection:
                 self._command(b"SELECT", database)
                 self._last_database = database
 
-    def __call__(self, *cmd, decoder=False, attributes=None, database=None, asking=False):
+    def __call__(self, *cmd, decoder=False, attributes=None, database=None, asking=False, stream=False, into=None, timeout=False):
         if not cmd:
             raise ValueError("No command provided")
         orig_decoder = None
-        if decoder != False or attributes is not None:
+        if decoder != False or attributes is not None or stream or into is not None:
             orig_decoder = self._decoder
             kwargs = self._settings.copy()
             if decoder != False:
                 kwargs["decoder"] = decoder
             if attributes is not None:
                 kwargs["attributes"] = attributes
-            self._decoder = RedisRespDecoder(**kwargs)
+            # Streaming replies requires the Python parser
+            if stream or into is not None:
+                kwargs["parser"] = "python"
+            self._decoder = create_decoder(**kwargs)
         try:
             self.set_database(database)
             if is_multiple_commands(*cmd):
-                return self._commands(*cmd)
+                if stream or into is not None:
+                    raise ValueError("Streaming a reply is not supported for multiple commands")
+                return self._commands(*cmd, timeout=timeout)
             else:
                 if asking:
                     self._command(b"ASKING")
-                return self._command(*cmd)
+                if stream or into is not None:
+                    res = self._command(*cmd, stream=True, timeout=timeout)
+                    if isinstance(res, StreamHeader):
+                        # The stream will restore the decoder when it's done
+                        restore_decoder = orig_decoder
+                        orig_decoder = None
+                        if into is not None:
+                            res = self._read_into(res, into, restore_decoder)
+                        else:
+                            res = self._stream(res, restore_decoder)
+                    return res
+                return self._command(*cmd, timeout=timeout)
         finally:
             if orig_decoder is not None:
                 self._decoder = orig_decoder
 
-    def _command(self, *cmd):
+    def _command(self, *cmd, stream=False, timeout=False):
         command_name = get_command_name(cmd)
         if command_name in not_allowed_push_commands:
             raise ValueError("Command %s is not allowed to be called directly, use the appropriate API instead" % cmd)
         if command_name == b"MULTI" and not self._allow_multi:
             raise ValueError("Take a connection if you want to use MULTI command.")
+        start = self._last_used = monotonic()
         self._send(*cmd)
-        res = self._recv()
+        res = self._recv(timeout, stream_header=stream)
+        # Blocking commands wait for data, not for the server
+        if command_name not in blocking_commands:
+            self._latency = monotonic() - start
         if isinstance(res, Error):
             if res.args[0].startswith("MOVED "):
-                self._seen_moved = True
+                self._seen_moved = parse_redirection(res.args[0])
             if res.args[0].startswith("ASK "):
-                _, _, address = res.args[0].split(" ")
-                self._seen_ask = address
+                _, self._seen_ask = parse_redirection(res.args[0])
             raise res
         if res == timeout_error:
             self.close()
             raise timeout_error
         return res
 
-    def _commands(self, *cmds):
+    def _commands(self, *cmds, timeout=False):
         for cmd in cmds:
             command_name = get_command_name(cmd)
             if command_name in not_allowed_push_commands:
                 raise ValueError("Command %s is not allowed to be called directly, use the appropriate API instead" % cmd)
             if command_name == b"MULTI" and not self._allow_multi:
                 raise ValueError("Take a connection if you want to use MULTI command.")
+        self._last_used = monotonic()
         self._send(*cmds)
         res = []
         found_errors = False
-        for _ in cmds:
-            try:
-                result = self._recv()
-                if isinstance(result, Error):
-                    if result.args[0].startswith("MOVED "):
-                        self.seen_moved = True
-                    found_errors = True
-                if result == timeout_error:
-                    self.close()
-            except Exception as e:
-                result = e
+        try:
+            self._recv_many(res, len(cmds), timeout)
+        except Exception as e:
+            res.extend([e] * (len(cmds) - len(res)))
+            found_errors = True
+        for result in res:
+            if isinstance(result, Error):
+                if result.args[0].startswith("MOVED "):
+                    self._seen_moved = parse_redirection(result.args[0])
                 found_errors = True
-            res.append(result)
         if found_errors:
             raise PipelinedExceptions(res)
         return res
 
+    def created(self):
+        return self._created
+
+    def last_used(self):
+        return self._last_used
+
+    # Checks if the connection still works, "peek" checks without blocking that the server did not close it, "ping" sends a PING
+    def check_health(self, method="peek"):
+        if self.closed():
+            return False
+        try:
+            if method == "ping":
+                self._command(b"PING")
+            elif not self._socket.alive():
+                self.close()
+                return False
+        except Exception:
+            return False
+        return True
+
+    # Returns the last command round trip time (in seconds) since the last call, or None
+    def latency(self):
+        latency = self._latency
+        self._latency = None
+        return latency
+
     def seen_moved(self):
         if self._seen_moved:
+            ret = self._seen_moved
             self._seen_moved = False
-            return True
+            return ret
         return False
 
     def seen_asked(self):
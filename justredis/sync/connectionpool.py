@@ -1,27 +1,218 @@
 from collections import deque
 from contextlib import contextmanager
+from functools import partial
+from threading import local
+from time import monotonic
+from weakref import ref
 
 
-from .connection import Connection
-from ..errors import ConnectionPoolError
+from .connection import Connection, ReplyStream
+from ..errors import CommunicationError, ConnectionPoolError, PipelinedExceptions
 from ..decoder import Error
+from ..encoder import PreparedCommand
+from ..utils import can_auto_pipeline
 from .environment import get_environment
 
 
+# Closes expired idle connections and keeps min_connections idle connections ready in the pool, it holds a weak reference so the pool can still be garbage collected
+def maintain_connections(pool_ref, refill):
+    while True:
+        refill.wait(1)
+        refill.clear()
+        pool = pool_ref()
+        if pool is None or pool._closed:
+            return
+        pool._reap()
+        pool._fill()
+        del pool
+
+
 # TODO (misc) can we relax the _lock ?
 
 
+class PendingCommand:
+    __slots__ = "cmd", "kwargs", "event", "result", "exception", "done", "leader"
+
+    def __init__(self, cmd, kwargs, event):
+        self.cmd = cmd
+        self.kwargs = kwargs
+        self.event = event
+        self.result = None
+        self.exception = None
+        self.done = False
+        self.leader = False
+
+
+# A caller waiting for a connection when the pool is full, it's handed an idle connection (or None for a free slot to open one)
+class Waiter:
+    __slots__ = "event", "conn", "granted"
+
+    def __init__(self, event):
+        self.event = event
+        self.conn = None
+        self.granted = False
+
+
+# Commands issued concurrently are queued, and sent together as a pipeline on a single connection by one of the callers (the leader).
+# While the leader waits for the replies, new commands are queued up, and the next leader will send them all at once.
+class AutoPipeline:
+    def __init__(self, pool, environment):
+        self._pool = pool
+        self._environment = environment
+        self._lock = environment.lock()
+        self._queue = deque()
+        self._flushing = False
+
+    def __call__(self, *cmd, **kwargs):
+        pending = PendingCommand(cmd, kwargs, self._environment.event())
+        with self._lock:
+            self._queue.append(pending)
+            if not self._flushing:
+                self._flushing = pending.leader = True
+        if not pending.leader:
+            pending.event.wait()
+        # We might have been woken up to be the next leader
+        if not pending.done:
+            self._flush()
+        if pending.exception is not None:
+            raise pending.exception
+        return pending.result
+
+    # Must be called with the lock held
+    def _next_leader(self):
+        if self._queue:
+            leader = self._queue[0]
+            leader.leader = True
+            return leader
+        self._flushing = False
+        return None
+
+    def _flush(self):
+        with self._lock:
+            batch = list(self._queue)
+            self._queue.clear()
+        try:
+            self._execute(batch)
+        finally:
+            for pending in batch:
+                if not pending.done:
+                    pending.exception = CommunicationError("The auto pipeline leader failed while sending the command")
+                    pending.done = True
+                pending.event.set()
+            with self._lock:
+                leader = self._next_leader()
+            if leader is not None:
+                leader.event.set()
+
+    def _execute(self, batch):
+        try:
+            conn = self._pool.take()
+        except Exception as e:
+            self._set_exception(batch, e)
+            return
+        try:
+            start = 0
+            # Commands with different settings are sent as seperate pipelines on the same connection
+            while start < len(batch):
+                kwargs = batch[start].kwargs
+                end = start + 1
+                while end < len(batch) and batch[end].kwargs == kwargs:
+                    end += 1
+                run = batch[start:end]
+                try:
+                    self._execute_run(conn, run, kwargs)
+                except Exception as e:
+                    # The connection is not usable anymore, the replies which were already read are kept
+                    self._set_exception([pending for pending in batch[start:] if not pending.done], e)
+                    return
+                start = end
+        finally:
+            # The redirections are handled by each command's caller
+            conn.seen_moved()
+            conn.seen_asked()
+            self._pool.release(conn)
+
+    # Sets the result of each command in the run
+    def _execute_run(self, conn, run, kwargs):
+        try:
+            results = conn(*[pending.cmd for pending in run], **kwargs)
+        except PipelinedExceptions as e:
+            results = e.args[0]
+        except ValueError:
+            # Nothing was sent (invalid command or encoding), so find out which one failed
+            results = None
+        if results is not None:
+            for pending, result in zip(run, results):
+                self._set_result(pending, result)
+            return
+        for pending in run:
+            try:
+                result = conn(*pending.cmd, **kwargs)
+            except (Error, ValueError) as e:
+                result = e
+            self._set_result(pending, result)
+
+    def _set_result(self, pending, result):
+        if isinstance(result, Exception):
+            pending.exception = result
+        else:
+            pending.result = result
+        pending.done = True
+
+    def _set_exception(self, batch, exception):
+        for pending in batch:
+            pending.exception = exception
+            pending.done = True
+
+
 class ConnectionPool:
-    def __init__(self, max_connections=None, wait_timeout=None, **kwargs):
+    def __init__(self, max_connections=None, wait_timeout=None, auto_pipeline=False, eject_errors=3, eject_timeout=10, min_connections=0, prewarm=False, idle_timeout=None, max_connection_age=None, health_check=None, pool_order="fifo", connection_affinity=False, max_waiters=None, refill=None, **kwargs):
+        if pool_order not in ("fifo", "lifo"):
+            raise ValueError("Unsupported pool_order %s" % pool_order)
         self._max_connections = max_connections
         self._wait_timeout = wait_timeout
+        self._min_connections = min_connections
+        self._idle_timeout = idle_timeout
+        self._max_connection_age = max_connection_age
+        self._health_check = health_check
+        # The server's health, used by the cluster to pick a server
+        self._latency = None
+        self._errors = 0
+        self._eject_errors = eject_errors
+        self._eject_timeout = eject_timeout
+        self._ejected_until = 0
+        # Waiting for a connection when the pool is full
+        self._max_waiters = max_waiters
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+        self._rejected = 0
         self._connection_settings = kwargs
+        self._environment = get_environment(**kwargs)
+        self._auto_pipeline = AutoPipeline(self, get_environment(**kwargs)) if auto_pipeline else None
 
         self._lock = get_environment(**kwargs).lock()
         self._limit = get_environment(**kwargs).semaphore(max_connections) if max_connections else None
         self._connections_available = deque()
+        # LIFO keeps using the same (hot) connections, and lets the rest expire
+        self._pop = self._connections_available.pop if pool_order == "lifo" else self._connections_available.popleft
+        # Remembers the last connection each thread used, to prefer it when it's idle
+        self._affinity = local() if connection_affinity else None
         self._connections_in_use = set()
+        # The callers waiting for a connection, in the order they started waiting
+        self._waiters = deque()
         self._closed = False
+        self._refill = None
+        if min_connections or idle_timeout or max_connection_age:
+            # A cluster maintains all of its servers connection pools from a single background thread, which waits on the refill event it provides
+            if refill is None:
+                environment = get_environment(**kwargs)
+                refill = environment.event()
+                environment.background(maintain_connections, ref(self), refill)
+            self._refill = refill
+            if prewarm:
+                self.prewarm()
 
     def __del__(self):
         self.close()
@@ -30,60 +221,253 @@ class ConnectionPool:
         with self._lock:
             if not self._closed:
                 # We do this first, so if another thread calls release it won't get back to the pool
-                for connection in self._connections_available:
+                for connection in list(self._connections_available):
                     connection.close()
-                for connection in self._connections_in_use:
+                for connection in list(self._connections_in_use):
                     connection.close()
                 self._connections_available.clear()
                 self._connections_in_use.clear()
-                self._limit = get_environment(**self.connection_settings).semaphore(self._max_connections) if self._max_connections else None
+                self._limit = get_environment(**self._connection_settings).semaphore(self._max_connections) if self._max_connections else None
             self._closed = True
+            # The waiters will find out the pool is closed
+            for waiter in list(self._waiters):
+                waiter.event.set()
 
     def take(self):
         if self._closed:
             raise ConnectionPoolError("Pool already closed")
         # TODO (correctness) cluster depends on this failing if closed ! guess we should add a health check
+        conn = self._affine_connection() if self._affinity is not None else None
+        if conn is None:
+            conn = self._idle_connection()
+            if conn is None:
+                conn = self._create()
+            if self._affinity is not None:
+                self._affinity.conn = ref(conn)
+        self._connections_in_use.add(conn)
+        if self._refill is not None and len(self._connections_available) < self._min_connections:
+            self._refill.set()
+        return conn
+
+    # Returns the connection this thread used last time, if it's idle
+    def _affine_connection(self):
+        # Like the other idle connections, it goes to the waiters first
+        if self._waiters:
+            return None
+        conn = getattr(self._affinity, "conn", None)
+        conn = conn() if conn is not None else None
+        if conn is None:
+            return None
+        try:
+            self._connections_available.remove(conn)
+        except ValueError:
+            return None
+        if not conn.closed() and self._usable(conn):
+            return conn
+        conn.close()
+        self._release_limit()
+        return None
+
+    def _idle_connection(self):
+        # The idle connections go to the waiters first, so new callers can't get ahead of them
+        if self._waiters:
+            return None
         try:
             while True:
-                conn = self._connections_available.popleft()
-                if not conn.closed():
-                    break
-                if self._limit is not None:
-                    self._limit.release()
+                conn = self._pop()
+                if not conn.closed() and self._usable(conn):
+                    return conn
+                conn.close()
+                self._release_limit()
         except IndexError:
-            if self._limit is not None and not self._limit.acquire(self._wait_timeout):
-                raise ConnectionPoolError("Could not acquire an connection form the pool")
-            try:
-                conn = Connection.create(**self._connection_settings)
-            except Exception:
-                if self._limit is not None:
-                    self._limit.release()
-                raise
-        self._connections_in_use.add(conn)
+            return None
+
+    def _create(self):
+        if self._limit is not None and (self._waiters or not self._limit.acquire(0)):
+            conn = self._wait()
+            if conn is not None:
+                return conn
+        try:
+            return Connection.create(**self._connection_settings)
+        except Exception:
+            self._release_limit()
+            self._failed()
+            raise
+
+    # Waits in line (up to wait_timeout) for a connection to be released, returns it or None if a free slot to open one was handed instead
+    def _wait(self):
+        if self._max_waiters is not None and len(self._waiters) >= self._max_waiters:
+            self._rejected += 1
+            raise ConnectionPoolError("Too many callers are waiting for a connection from the pool")
+        waiter = Waiter(self._environment.event())
+        start = monotonic()
+        with self._lock:
+            self._waiters.append(waiter)
+        # A connection might have been released before we got in line
+        self._wake()
+        waiter.event.wait(self._wait_timeout)
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+        waited = monotonic() - start
+        self._waits += 1
+        self._wait_time += waited
+        self._max_wait_time = max(self._max_wait_time, waited)
+        if not waiter.granted:
+            if self._closed:
+                raise ConnectionPoolError("Pool already closed")
+            self._timeouts += 1
+            raise ConnectionPoolError("Could not acquire an connection form the pool")
+        conn = waiter.conn
+        # We keep the slot of a bad connection, and open a new one instead
+        if conn is not None and (conn.closed() or not self._usable(conn)):
+            conn.close()
+            conn = None
         return conn
 
-    def release(self, conn):
+    # Hands the idle connections and free slots to the waiters, in the order they started waiting
+    def _wake(self):
         with self._lock:
+            while self._waiters:
+                try:
+                    conn = self._pop()
+                except IndexError:
+                    if not self._limit.acquire(0):
+                        break
+                    conn = None
+                waiter = self._waiters.popleft()
+                waiter.conn = conn
+                waiter.granted = True
+                waiter.event.set()
+
+    def _release_limit(self):
+        if self._limit is not None:
+            self._limit.release()
+            if self._waiters:
+                self._wake()
+
+    def _expired(self, conn, now):
+        if self._max_connection_age is not None and now - conn.created() >= self._max_connection_age:
+            return True
+        return self._idle_timeout is not None and now - conn.last_used() >= self._idle_timeout
+
+    # Checks an idle connection before it's used
+    def _usable(self, conn):
+        if (self._idle_timeout is not None or self._max_connection_age is not None) and self._expired(conn, monotonic()):
+            return False
+        return self._health_check is None or conn.check_health(self._health_check)
+
+    # Closes the expired idle connections, used by the background thread
+    def _reap(self):
+        if self._idle_timeout is None and self._max_connection_age is None:
+            return
+        now = monotonic()
+        for _ in range(len(self._connections_available)):
             try:
-                self._connections_in_use.remove(conn)
-            # TODO (correctness) should we release the self._limit here as well ? (or just make close forever)
-            # If this fails, it's a connection from a previous cycle, don't reuse it
-            except KeyError:
+                conn = self._connections_available.popleft()
+            except IndexError:
+                break
+            if conn.closed() or self._expired(conn, now):
                 conn.close()
-                return
-            if not conn.closed():
+                self._release_limit()
+            else:
                 self._connections_available.append(conn)
-            elif self._limit is not None:
-                self._limit.release()
+
+    # Asks the background refiller to open min_connections connections now
+    def prewarm(self):
+        if self._refill is not None:
+            self._refill.set()
+
+    def _fill(self):
+        while len(self._connections_available) < self._min_connections and not self._closed:
+            if self._limit is not None and (self._waiters or not self._limit.acquire(0)):
+                break
+            try:
+                conn = Connection.create(**self._connection_settings)
+            except Exception:
+                self._release_limit()
+                self._failed()
+                break
+            self._connections_available.append(conn)
+            # The pool might have been closed meanwhile
+            if self._closed:
+                conn.close()
+            elif self._waiters:
+                self._wake()
+
+    def release(self, conn):
+        # Only I/O errors count, a connection closed by the caller (such as a stream not read completely, or a timeout) says nothing about the server
+        if conn.io_failed():
+            self._failed()
+        elif not conn.closed():
+            self._errors = 0
+            latency = conn.latency()
+            if latency is not None:
+                self._latency = latency if self._latency is None else self._latency * 0.8 + latency * 0.2
+        # The set and deque operations are atomic, so there is no need for the lock here
+        try:
+            self._connections_in_use.remove(conn)
+        # TODO (correctness) should we release the self._limit here as well ? (or just make close forever)
+        # If this fails, it's a connection from a previous cycle, don't reuse it
+        except KeyError:
+            conn.close()
+            return
+        if not conn.closed():
+            self._connections_available.append(conn)
+            # The pool might have been closed meanwhile
+            if self._closed:
+                conn.close()
+            elif self._waiters:
+                self._wake()
+        else:
+            self._release_limit()
+
+    def _failed(self):
+        self._errors += 1
+        if self._errors >= self._eject_errors:
+            self._ejected_until = monotonic() + self._eject_timeout
+
+    # Returns the moving average of the commands latency (in seconds), or None if not measured yet
+    def latency(self):
+        return self._latency
+
+    # A server which keeps failing is ejected for eject_timeout seconds, afterwards it can be tried again
+    def healthy(self):
+        return self._errors < self._eject_errors or monotonic() >= self._ejected_until
+
+    # The pool saturation, the wait times are in seconds
+    def stats(self):
+        return {
+            "in_use": len(self._connections_in_use),
+            "idle": len(self._connections_available),
+            "waiting": len(self._waiters),
+            "waits": self._waits,
+            "wait_time": self._wait_time,
+            "max_wait_time": self._max_wait_time,
+            "timeouts": self._timeouts,
+            "rejected": self._rejected,
+            "errors": self._errors,
+        }
+
+    def prepare(self, *cmd):
+        return PreparedCommand(*cmd, encoder=self._connection_settings.get("encoder"))
 
     def __call__(self, *cmd, **kwargs):
         if not cmd:
             raise ValueError("No command provided")
+        if self._auto_pipeline is not None and can_auto_pipeline(cmd, kwargs):
+            return self._auto_pipeline(*cmd, **kwargs)
         conn = self.take()
+        res = None
         try:
-            return conn(*cmd, **kwargs)
+            res = conn(*cmd, **kwargs)
+            return res
         finally:
-            self.release(conn)
+            # A streamed reply keeps the connection until it's consumed
+            if isinstance(res, ReplyStream):
+                res.on_close(partial(self.release, conn))
+            else:
+                self.release(conn)
 
     @contextmanager
     def connection(self, **kwargs):
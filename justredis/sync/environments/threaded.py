@@ -1,4 +1,5 @@
-from threading import Lock, Semaphore
+from queue import Queue
+from threading import Event, Lock, Semaphore, Thread
 import socket
 import sys
 import ssl
@@ -72,6 +73,8 @@ class SocketWrapper:
         self._buffer = bytearray(buffersize)
         self._view = memoryview(self._buffer)
         self._socket = socket_factory(**kwargs)
+        # SSL sockets (and some platforms) do not support sendmsg
+        self._sendmsg = hasattr(self._socket, "sendmsg") and not isinstance(self._socket, ssl.SSLSocket)
 
     def close(self):
         self._socket.close()
@@ -79,6 +82,26 @@ class SocketWrapper:
     def send(self, data):
         self._socket.sendall(data)  # AWAIT
 
+    # Sends a list of buffers with as few system calls as possible, without concatenating them
+    def sendv(self, buffers):
+        if not self._sendmsg:
+            for buffer in buffers:
+                self._socket.sendall(buffer)  # AWAIT
+            return
+        while buffers:
+            sent = self._socket.sendmsg(buffers)  # AWAIT
+            # Drop the buffers which were fully sent, and keep the unsent part of a partially sent one
+            for index, buffer in enumerate(buffers):
+                length = buffer.nbytes if isinstance(buffer, memoryview) else len(buffer)
+                if sent < length:
+                    buffers = buffers[index:]
+                    if sent:
+                        buffers[0] = memoryview(buffer).cast("B")[sent:]
+                    break
+                sent -= length
+            else:
+                break
+
     # If you override this, make sure to return an empty bytes for EOF and a None for timeout !
     def recv(self, timeout=False):
         if timeout != False:
@@ -95,6 +118,28 @@ class SocketWrapper:
             r = self._socket.recv_into(self._buffer)  # AWAIT
         return self._view[:r]
 
+    # Reads directly into the given writable buffer, returns 0 for EOF
+    def recv_into(self, view):
+        return self._socket.recv_into(view)  # AWAIT
+
+    # Checks without blocking that the server did not close the connection (or sent unexpected data)
+    def alive(self):
+        # SSL sockets do not support peeking (and might have pending TLS records), so there is no way to know
+        if isinstance(self._socket, ssl.SSLSocket):
+            return True
+        # With a socket timeout python waits for the socket to be readable even when asked not to block, so we switch to non blocking for the peek
+        timeout = self._socket.gettimeout()
+        self._socket.setblocking(False)
+        try:
+            self._socket.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self._socket.settimeout(timeout)
+        return False
+
     def peername(self):
         peername = self._socket.getpeername()
         # TODO (misc) is there a lib where this is not the case ?, we can also just return the peername in the connect functions.
@@ -111,7 +156,7 @@ class OurSemaphore:
         self._semaphore.release()
 
     def acquire(self, timeout=None):
-        self._semaphore.acquire(True, timeout)  # AWAIT
+        return self._semaphore.acquire(True, timeout)  # AWAIT
 
 
 class OurLock:
@@ -125,6 +170,20 @@ class OurLock:
         self._lock.release()  # AWAIT
 
 
+class OurEvent:
+    def __init__(self):
+        self._event = Event()
+
+    def set(self):
+        self._event.set()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)  # AWAIT
+
+    def clear(self):
+        self._event.clear()
+
+
 class ThreadedEnvironment:
     @staticmethod
     def socket(socket_type="tcp", **kwargs):
@@ -145,3 +204,59 @@ class ThreadedEnvironment:
     @staticmethod
     def lock():
         return OurLock()
+
+    @staticmethod
+    def event():
+        return OurEvent()
+
+    # Runs the function in the background, for the lifetime of the process
+    @staticmethod
+    def background(function, *args):
+        Thread(target=function, args=args, daemon=True).start()
+
+    # Runs the functions concurrently and returns their results, the first one runs on the calling thread
+    @staticmethod
+    def gather(*functions):
+        results = [None] * len(functions)
+        errors = []
+
+        def run(index, function):
+            try:
+                results[index] = function()
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [Thread(target=run, args=(index, function), daemon=True) for index, function in enumerate(functions[1:], 1)]
+        for thread in threads:
+            thread.start()
+        try:
+            run(0, functions[0])
+        finally:
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    # Runs the functions concurrently with at most limit threads, and calls callback(index, result, exception) (in the calling thread) as each one finishes
+    @staticmethod
+    def as_completed(functions, callback, limit=None):
+        finished = Queue()
+        indexes = iter(range(len(functions)))
+        lock = Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    index = next(indexes, None)
+                if index is None:
+                    return
+                try:
+                    finished.put((index, functions[index](), None))
+                except BaseException as e:
+                    finished.put((index, None, e))
+
+        for _ in range(min(limit or len(functions), len(functions))):
+            Thread(target=worker, daemon=True).start()
+        for _ in range(len(functions)):
+            callback(*finished.get())  # AWAIT
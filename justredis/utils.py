@@ -77,3 +77,37 @@ def is_multiple_commands(*cmd):
         return True
     else:
         return False
+
+
+# Parses a MOVED / ASK error message (i.e. "MOVED 3999 127.0.0.1:6381") to the hashslot and the address
+def parse_redirection(message):
+    _, hashslot, address = message.split(" ")
+    host, _, port = address.rpartition(":")
+    return int(hashslot), (host, int(port))
+
+
+# A rough estimate of the encoded size of a command
+def command_size(cmd):
+    size = 0
+    for arg in cmd:
+        if isinstance(arg, memoryview):
+            size += arg.nbytes
+        elif isinstance(arg, (bytes, bytearray, str)):
+            size += len(arg)
+        # The header and the numbers
+        size += 16
+    return size
+
+
+# Blocking commands would stall all the other commands sharing the connection
+blocking_commands = set((b"BLPOP", b"BRPOP", b"BRPOPLPUSH", b"BLMOVE", b"BLMPOP", b"BZPOPMIN", b"BZPOPMAX", b"BZMPOP", b"XREAD", b"XREADGROUP", b"WAIT"))
+auto_pipeline_settings = set(("decoder", "attributes", "database"))
+
+
+def can_auto_pipeline(cmd, kwargs):
+    if is_multiple_commands(*cmd):
+        return False
+    for setting in kwargs:
+        if setting not in auto_pipeline_settings:
+            return False
+    return get_command_name(cmd) not in blocking_commands
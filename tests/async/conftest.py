@@ -111,3 +111,15 @@ async def no_cluster_client(request):
 async def client_with_blah_password(request):
     async for item in redis_with_client(request.param, extraparams="--requirepass blah", password="blah"):
         yield item
+
+
+@pytest.fixture(params=generate_fixture_params(False))
+async def min_connections_client(request):
+    async for item in redis_with_client(request.param, min_connections=3):
+        yield item
+
+
+@pytest.fixture(params=generate_fixture_params(False))
+async def idle_timeout_client(request):
+    async for item in redis_with_client(request.param, idle_timeout=0.5):
+        yield item
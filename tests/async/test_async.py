@@ -117,6 +117,55 @@ async def test_pipeline(client):
     assert await r(("set", "abc", "def"), ("get", "abc")) == [b"OK", b"def"]
 
 
+@pytest.mark.anyio
+async def test_min_connections(min_connections_client):
+    r = min_connections_client
+    # The idle connections are opened together with the first one
+    assert await r("set", "min_connections", "a") == b"OK"
+    stats = list(r.pool_stats().values())
+    assert sum(stat["idle"] for stat in stats) >= 3
+    async with await r.connection(key="min_connections") as c:
+        assert await c("get", "min_connections") == b"a"
+        stats = list(r.pool_stats().values())
+        assert sum(stat["in_use"] for stat in stats) == 1
+        assert sum(stat["idle"] for stat in stats) >= 2
+
+
+@pytest.mark.anyio
+async def test_idle_timeout(idle_timeout_client):
+    r = idle_timeout_client
+    client_id = await r("client", "id")
+    assert await r("client", "id") == client_id
+    await anyio.sleep(1)
+    # The idle connection expired, and a new one is opened instead
+    assert await r("client", "id") != client_id
+    assert sum(stat["idle"] + stat["in_use"] for stat in r.pool_stats().values()) == 1
+
+
+@pytest.mark.anyio
+async def test_stream(client):
+    r = client
+    data = b"test_stream" * 100 * 1024
+    assert await r("set", "{stream}a", data) == b"OK"
+    async with await r("get", "{stream}a", stream=True) as chunks:
+        assert b"".join([chunk async for chunk in chunks]) == data
+    assert await r("get", "{stream}nothing", stream=True) == None
+    assert [item async for item in await r("mget", "{stream}a", "{stream}nothing", stream=True)] == [data, None]
+    buffer = bytearray(len(data))
+    assert await r("get", "{stream}a", into=buffer) == len(data)
+    assert buffer == data
+
+
+@pytest.mark.anyio
+async def test_lazy_pipeline(client):
+    r = client
+    async with r.pipeline(max_commands=10) as p:
+        results = [await p("set", "{lazy_pipeline}%d" % i, i) for i in range(25)]
+    assert [result.result() for result in results] == [b"OK"] * 25
+    replies = [reply async for reply in r.pipeline(max_commands=10).execute(("get", "{lazy_pipeline}%d" % i) for i in range(25))]
+    assert replies == [b"%d" % i for i in range(25)]
+
+
 # TODO (misc) add some extra checks here for invalid states
 @pytest.mark.anyio
 async def test_multi(client):
@@ -214,6 +263,13 @@ async def test_server_cluster(cluster_client):
     result = list(result.values())
     result = [i for s in result for i in s]
     assert set(result) == set([b"cluster_aa", b"cluster_bb", b"cluster_cc"])
+    result = []
+
+    async def on_reply(address, reply):
+        result.extend(reply)
+
+    await r("keys", "cluster_*", endpoint="masters", on_reply=on_reply)
+    assert set(result) == set([b"cluster_aa", b"cluster_bb", b"cluster_cc"])
 
 
 @pytest.mark.anyio
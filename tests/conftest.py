@@ -50,12 +50,12 @@ def redis_with_client(dockerimage="redis", extraparams="", **kwargs):
             instance.close()
 
 
-def redis_cluster_with_client(dockerimage="redis", extraparams=""):
+def redis_cluster_with_client(dockerimage="redis", extraparams="", replicas=0, **kwargs):
     from . import redis_server
 
     if isinstance(dockerimage, (tuple, list)):
         dockerimage = dockerimage[0]
-    servers, stdout = redis_server.start_cluster(3, extraparams=extraparams, **get_runtime_params_for_redis(dockerimage))
+    servers, stdout = redis_server.start_cluster(3, extraparams=extraparams, replicas=replicas, **get_runtime_params_for_redis(dockerimage))
     try:
         with Redis(address=("localhost", servers[0].port), resp_version=-1) as r:
             import time
@@ -70,13 +70,20 @@ def redis_cluster_with_client(dockerimage="redis", extraparams=""):
                     if b"cluster_state:ok" not in res:
                         ready = False
                         break
+                # The replicas might show up in the slots only after the cluster is up
+                if ready and replicas:
+                    ready = all(len(slot) == 3 + replicas for slot in r(b"CLUSTER", b"SLOTS"))
                 if ready:
                     break
                 time.sleep(1)
                 wait -= 1
             if not wait:
                 raise Exception("Cluster is down, could not run test")
-            yield r
+            if not kwargs:
+                yield r
+            else:
+                with Redis(address=("localhost", servers[0].port), resp_version=-1, **kwargs) as client:
+                    yield client
     finally:
         for server in servers:
             server.close()
@@ -128,3 +135,67 @@ def no_cluster_client(request):
 def client_with_blah_password(request):
     for item in redis_with_client(request.param, extraparams="--requirepass blah", password="blah"):
         yield item
+
+
+@pytest.fixture(scope="module", params=generate_fixture_params(False))
+def auto_pipeline_client(request):
+    for item in redis_with_client(request.param, auto_pipeline=True):
+        yield item
+
+
+@pytest.fixture(scope="module", params=generate_fixture_params(False))
+def limited_pool_client(request):
+    for item in redis_with_client(request.param, max_connections=1, wait_timeout=0.1):
+        yield item
+
+
+@pytest.fixture(scope="module", params=generate_fixture_params(False))
+def health_check_client(request):
+    for item in redis_with_client(request.param, health_check="peek", socket_timeout=2):
+        yield item
+
+
+@pytest.fixture(scope="module", params=generate_fixture_params())
+def min_connections_client(request):
+    if request.param[1]:
+        for item in redis_cluster_with_client(request.param[0], min_connections=3, prewarm=True):
+            yield item
+    else:
+        for item in redis_with_client(request.param[0], min_connections=3, prewarm=True):
+            yield item
+
+
+@pytest.fixture(scope="module", params=generate_fixture_params(False))
+def idle_timeout_client(request):
+    for item in redis_with_client(request.param, idle_timeout=0.5):
+        yield item
+
+
+@pytest.fixture(scope="module", params=generate_fixture_params(False))
+def max_connection_age_client(request):
+    for item in redis_with_client(request.param, max_connection_age=0.5):
+        yield item
+
+
+@pytest.fixture(scope="module", params=generate_fixture_params(False))
+def lifo_client(request):
+    for item in redis_with_client(request.param, pool_order="lifo"):
+        yield item
+
+
+@pytest.fixture(scope="module", params=generate_fixture_params(False))
+def affinity_client(request):
+    for item in redis_with_client(request.param, connection_affinity=True):
+        yield item
+
+
+@pytest.fixture(scope="module", params=generate_fixture_params("only"))
+def replica_client(request):
+    for item in redis_cluster_with_client(request.param[0], replicas=1, read_from="replica"):
+        yield item
+
+
+@pytest.fixture(scope="module", params=generate_fixture_params("only"))
+def static_table_client(request):
+    for item in redis_cluster_with_client(request.param[0], replicas=1, read_from="replica", command_table="static"):
+        yield item
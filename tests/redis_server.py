@@ -15,12 +15,12 @@ elif sys.platform.startswith("win"):
 
 
 # TODO (misc) make this a contextmanager to cleanup properly on failures (altough currently the caller handles this)
-def start_cluster(masters, dockerimage=None, extraparams="", extrapath="", ipv4=True):
+def start_cluster(masters, dockerimage=None, extraparams="", extrapath="", ipv4=True, replicas=0):
     addr = "127.0.0.1" if ipv4 else "::1"
     ret = []
     if dockerimage is None:
         subprocess.call("rm /tmp/justredis_cluster*.conf", shell=True)
-    for x in range(masters):
+    for x in range(masters * (replicas + 1)):
         ret.append(RedisServer(dockerimage=dockerimage, extraparams="--cluster-enabled yes --cluster-config-file /tmp/justredis_cluster%d.conf" % x, extrapath=extrapath))
     # Requires redis-cli from version 5 for cluster management support
     orig_path = os.getenv("PATH")
@@ -29,14 +29,14 @@ def start_cluster(masters, dockerimage=None, extraparams="", extrapath="", ipv4=
             os.putenv("PATH", os.pathsep.join((os.getenv("PATH"), extrapath)))
         if dockerimage:
             stdout = subprocess.Popen(
-                "docker run -i --rm --net=host " + dockerimage + " redis-cli --cluster create " + " ".join(["%s:%d" % (addr, server.port) for server in ret]),
+                "docker run -i --rm --net=host " + dockerimage + " redis-cli --cluster create " + " ".join(["%s:%d" % (addr, server.port) for server in ret]) + " --cluster-replicas %d" % replicas,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 shell=True,
             ).communicate(b"yes\n")
         else:
             stdout = subprocess.Popen(
-                "redis-cli --cluster create " + " ".join(["%s:%d" % (addr, server.port) for server in ret]), stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True
+                "redis-cli --cluster create " + " ".join(["%s:%d" % (addr, server.port) for server in ret]) + " --cluster-replicas %d" % replicas, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True
             ).communicate(b"yes\n")
     finally:
         os.putenv("PATH", orig_path)
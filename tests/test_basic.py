@@ -1,5 +1,6 @@
 import pytest
-from justredis import Redis, Error, CommunicationError
+from decimal import Decimal
+from justredis import Redis, Error, CommunicationError, ConnectionPoolError, register_encoder, unregister_encoder
 
 
 # TODO (misc) copy all of misc/example.py into here
@@ -79,6 +80,14 @@ def test_some_encodings(client):
     r("set", "{check}_b", "b")
     assert r("get", "{check}_a", decoder="utf8") == "a"
     assert r("mget", "{check}_a", "{check}_b", decoder="utf8") == ["a", "b"]
+    register_encoder(Decimal, str)
+    try:
+        assert r("set", "{check}_c", Decimal("1.10")) == b"OK"
+        assert r("get", "{check}_c") == b"1.10"
+    finally:
+        unregister_encoder(Decimal)
+    with pytest.raises(ValueError):
+        r("set", "{check}_c", Decimal("1.10"))
 
 
 def test_chunk_encoded_command(client):
@@ -88,6 +97,41 @@ def test_chunk_encoded_command(client):
     assert r("mget", "test_chunk_encoded_command_a" * 3500, "test_chunk_encoded_command_a" * 3500, "test_chunk_encoded_command_a" * 3500) == [None, None, None]
 
 
+def test_stream(client):
+    r = client
+    data = b"test_stream" * 100 * 1024
+    assert r("set", "{stream}a", data) == b"OK"
+    with r("get", "{stream}a", stream=True) as chunks:
+        assert b"".join(chunks) == data
+    assert r("get", "{stream}nothing", stream=True) == None
+    assert list(r("mget", "{stream}a", "{stream}nothing", stream=True)) == [data, None]
+    # Closing the stream before it's exhausted should not break the next commands
+    for _ in range(3):
+        chunks = r("get", "{stream}a", stream=True)
+        next(chunks)
+        chunks.close()
+    # And it's not counted as a server error
+    assert all(stat["errors"] == 0 for stat in r.pool_stats().values())
+    assert r("get", "{stream}a") == data
+    buffer = bytearray(len(data) + 10)
+    assert r("get", "{stream}a", into=buffer) == len(data)
+    assert buffer[: len(data)] == data
+    assert r("get", "{stream}nothing", into=buffer) == None
+    with pytest.raises(ValueError):
+        r("get", "{stream}a", into=bytearray(10))
+
+
+def test_prepare(client):
+    r = client
+    set_value = r.prepare("set", None, None)
+    get_value = r.prepare(b"GET", None)
+    assert r(*set_value.bind("{prepare}a", "b")) == b"OK"
+    assert r(*get_value.bind("{prepare}a")) == b"b"
+    assert r(set_value.bind("{prepare}c", 1), get_value.bind("{prepare}c"), get_value.bind("{prepare}a")) == [b"OK", b"1", b"b"]
+    with pytest.raises(ValueError):
+        get_value.bind()
+
+
 def test_eval(client):
     r = client
     assert r("set", "evaltest", "a") == b"OK"
@@ -105,6 +149,219 @@ def test_pipeline(client):
     assert r(("set", "abc", "def"), ("get", "abc")) == [b"OK", b"def"]
 
 
+def test_pipeline_cluster(cluster_client):
+    r = cluster_client
+    commands = [("set", "pipeline_cluster%d" % i, i) for i in range(50)] + [("get", "pipeline_cluster%d" % i) for i in range(50)]
+    result = r(*commands)
+    assert result[:50] == [b"OK"] * 50
+    assert result[50:] == [b"%d" % i for i in range(50)]
+
+
+def test_cross_slot_commands(cluster_client):
+    r = cluster_client
+    keys = ["cross_slot%d" % i for i in range(50)]
+    assert r("mset", *[item for key in keys for item in (key, key)]) == b"OK"
+    assert r("mget", *keys, "cross_slot_nothing") == [key.encode() for key in keys] + [None]
+    assert r("exists", *keys) == 50
+    assert [item.data for item in r("mget", *keys, attributes=True).data] == [key.encode() for key in keys]
+    assert r("exists", *keys, attributes=True).data == 50
+    assert r("del", *keys) == 50
+
+
+def test_movable_keys(cluster_client):
+    r = cluster_client
+    for i in range(10):
+        assert r("eval", "return redis.call('set', KEYS[1], ARGV[1])", 1, "movable%d" % i, i) == b"OK"
+        assert r("get", "movable%d" % i) == b"%d" % i
+    assert r("eval", "return 1", 0) == 1
+
+
+def test_lazy_pipeline(client):
+    r = client
+    with r.pipeline(max_commands=10) as p:
+        results = [p("set", "{lazy_pipeline}%d" % i, i) for i in range(25)]
+        assert results[0].done() and not results[-1].done()
+        error = p("nosuchcommand")
+    assert [result.result() for result in results] == [b"OK"] * 25
+    with pytest.raises(Error):
+        error.result()
+    replies = list(r.pipeline(max_commands=10).execute(("get", "{lazy_pipeline}%d" % i) for i in range(25)))
+    assert replies == [b"%d" % i for i in range(25)]
+
+
+def test_pipeline_many(client):
+    r = client
+    cmds = [("set", "{pipeline_many}%d" % i, i) for i in range(1000)] + [("get", "{pipeline_many}%d" % i) for i in range(1000)]
+    result = r(*cmds)
+    assert result[:1000] == [b"OK"] * 1000
+    assert result[1000:] == [b"%d" % i for i in range(1000)]
+
+
+def test_auto_pipeline(auto_pipeline_client):
+    from threading import Thread
+
+    r = auto_pipeline_client
+    results = []
+
+    def worker(index):
+        results.append(r("set", "auto_pipeline%d" % index, index) == b"OK" and r("get", "auto_pipeline%d" % index) == b"%d" % index)
+
+    threads = [Thread(target=worker, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * 20
+    with pytest.raises(Error):
+        r("nosuchcommand")
+
+
+def test_health_check_peek(health_check_client):
+    from time import monotonic
+
+    r = health_check_client
+    client_id = r("client", "id")
+    start = monotonic()
+    for _ in range(5):
+        assert r("client", "id") == client_id
+    # A healthy idle connection is kept, and checking it does not wait for the socket timeout
+    assert monotonic() - start < 1
+    assert sum(stat["idle"] + stat["in_use"] for stat in r.pool_stats().values()) == 1
+
+
+def test_pool_waiters(limited_pool_client):
+    r = limited_pool_client
+    with r.connection(key="pool_waiters"):
+        with pytest.raises(ConnectionPoolError):
+            r("get", "pool_waiters")
+    assert r("set", "pool_waiters", "a") == b"OK"
+    stats = list(r.pool_stats().values())
+    assert sum(stat["timeouts"] for stat in stats) >= 1
+    assert sum(stat["waiting"] for stat in stats) == 0
+
+
+def test_min_connections(min_connections_client):
+    from time import sleep
+
+    r = min_connections_client
+
+    def wait_for_idle(count):
+        for _ in range(50):
+            if all(stat["idle"] >= count for stat in r.pool_stats().values()):
+                return True
+            sleep(0.1)
+        return False
+
+    assert r("set", "min_connections", "a") == b"OK"
+    # The idle connections are opened in the background, for all of the servers
+    assert wait_for_idle(3)
+    with r.connection(key="min_connections") as c:
+        assert c("get", "min_connections") == b"a"
+        assert sum(stat["in_use"] for stat in r.pool_stats().values()) == 1
+        # The connection taken is replaced
+        assert wait_for_idle(3)
+
+
+def test_idle_timeout(idle_timeout_client):
+    from time import sleep
+
+    r = idle_timeout_client
+    client_id = r("client", "id")
+    assert r("client", "id") == client_id
+    sleep(1)
+    # The idle connection expired, and a new one is opened instead
+    assert r("client", "id") != client_id
+    assert sum(stat["idle"] + stat["in_use"] for stat in r.pool_stats().values()) == 1
+
+
+def test_max_connection_age(max_connection_age_client):
+    from time import sleep
+
+    r = max_connection_age_client
+    client_id = r("client", "id")
+    # The connection is replaced once it's too old, even though it's used all the time
+    for _ in range(20):
+        sleep(0.1)
+        new_client_id = r("client", "id")
+        if new_client_id != client_id:
+            break
+    assert new_client_id != client_id
+    assert r("client", "id") == new_client_id
+
+
+def test_pool_order_lifo(lifo_client):
+    r = lifo_client
+    # The command table and the slots are loaded first, so no other connections are taken while checking
+    r("client", "id")
+    with r.connection() as first:
+        first_id = first("client", "id")
+        with r.connection() as second:
+            assert second("client", "id") != first_id
+    # The connection released last is the one taken next
+    assert r("client", "id") == first_id
+
+
+def test_connection_affinity(affinity_client):
+    from threading import Thread
+
+    r = affinity_client
+    ids = []
+
+    def worker():
+        with r.connection() as c:
+            ids.append(c("client", "id"))
+
+    with r.connection() as c:
+        client_id = c("client", "id")
+        thread = Thread(target=worker)
+        thread.start()
+        thread.join()
+    assert ids[0] != client_id
+    # The other thread's connection was released first, but this thread gets back the one it used
+    for _ in range(3):
+        assert r("client", "id") == client_id
+
+
+def test_connection_affinity_waiters(affinity_client):
+    from threading import Thread
+    from time import sleep
+    from justredis.sync.connectionpool import ConnectionPool
+
+    pool = ConnectionPool(address=affinity_client.endpoints()[0][0], max_connections=1, wait_timeout=5, connection_affinity=True)
+    order = []
+
+    def worker():
+        conn = pool.take()
+        order.append("worker")
+        pool.release(conn)
+
+    def hold_lock():
+        with pool._lock:
+            sleep(0.5)
+
+    def wait_for(stat, value):
+        while pool.stats()[stat] != value:
+            sleep(0.01)
+
+    try:
+        conn = pool.take()
+        waiter = Thread(target=worker)
+        waiter.start()
+        wait_for("waiting", 1)
+        # The connection is put back as idle, but the waiter is not woken up yet
+        Thread(target=hold_lock).start()
+        sleep(0.05)
+        Thread(target=pool.release, args=(conn,)).start()
+        wait_for("idle", 1)
+        # The connection this thread used last is idle, but the waiter gets it first
+        pool.release(pool.take())
+        order.append("affinity")
+        waiter.join()
+        assert order == ["worker", "affinity"]
+    finally:
+        pool.close()
+
+
 # TODO (misc) add some extra checks here for invalid states
 def test_multi(client):
     r = client
@@ -196,6 +453,9 @@ def test_server_cluster(cluster_client):
     result = list(result.values())
     result = [i for s in result for i in s]
     assert set(result) == set([b"cluster_aa", b"cluster_bb", b"cluster_cc"])
+    result = []
+    r("keys", "cluster_*", endpoint="masters", on_reply=lambda address, reply: result.extend(reply))
+    assert set(result) == set([b"cluster_aa", b"cluster_bb", b"cluster_cc"])
 
 
 def test_moved_no_cluster(no_cluster_client):
@@ -220,3 +480,128 @@ def test_moved_cluster(cluster_client):
     result = list(result.values())
     assert b"a" in result
     assert len([x for x in result if isinstance(x, Error) and x.args[0].startswith("MOVED ")]) == 2
+
+
+def test_moved_patches_slots(cluster_client):
+    from justredis.sync.cluster import calc_hashslot
+
+    r = cluster_client
+    assert r("set", "moved_patch", "a") == b"OK"
+    pool = r._connection_pool
+    hashslot = calc_hashslot(b"moved_patch")
+    nodes, slot_table, _ = pool._slots
+    address = nodes[slot_table[hashslot]]
+    # Point the hashslot to the wrong server, the MOVED reply should fix it
+    slot_table[hashslot] = (slot_table[hashslot] + 1) % len(nodes)
+    assert r("get", "moved_patch") == b"a"
+    nodes, slot_table, _ = pool._slots
+    assert nodes[slot_table[hashslot]] == address
+    assert r("get", "moved_patch") == b"a"
+
+
+def test_hashslot_without_node(cluster_client):
+    from justredis.sync.cluster import calc_hashslot, no_node
+
+    r = cluster_client
+    assert r("set", "hashslot_without_node", "a") == b"OK"
+    pool = r._connection_pool
+    hashslot = calc_hashslot(b"hashslot_without_node")
+    nodes, slot_table, _ = pool._slots
+    address = nodes[slot_table[hashslot]]
+    # The slots were just refreshed, but a hashslot without a server is checked again anyhow
+    slot_table[hashslot] = no_node
+    assert r("get", "hashslot_without_node") == b"a"
+    nodes, slot_table, _ = pool._slots
+    assert nodes[slot_table[hashslot]] == address
+
+def test_server_health(no_cluster_client):
+    import socket
+    from time import sleep
+    from justredis.sync.connectionpool import ConnectionPool
+
+    pool = ConnectionPool(address=no_cluster_client.endpoints()[0][0])
+    try:
+        assert pool.latency() is None
+        conn = pool.take()
+        assert conn("ping") == b"PONG"
+        pool.release(conn)
+        assert pool.latency() > 0 and pool.healthy()
+    finally:
+        pool.close()
+    # A server which refuses connections is ejected after eject_errors failures in a row, and tried again after eject_timeout
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    address = sock.getsockname()
+    sock.close()
+    pool = ConnectionPool(address=address, eject_errors=2, eject_timeout=0.5)
+    try:
+        for _ in range(2):
+            assert pool.healthy()
+            with pytest.raises(CommunicationError):
+                pool.take()
+        assert not pool.healthy()
+        assert pool.stats()["errors"] == 2
+        sleep(0.6)
+        assert pool.healthy()
+    finally:
+        pool.close()
+
+
+def test_keyless_commands(cluster_client):
+    from time import monotonic
+
+    r = cluster_client
+    assert r("set", "keyless_commands", "a") == b"OK"
+    pool = r._connection_pool
+    nodes = pool._slots[0]
+    pools = [pool._address_pool(address) for address in nodes]
+    latencies = [server._latency for server in pools]
+    try:
+        pools[0]._latency = 0.001
+        pools[1]._latency = 0.0012
+        pools[2]._latency = 0.1
+        pool._keyless = None
+        # The keyless commands are spread on the servers with about the same lowest latency
+        assert {pool._keyless_address(nodes) for _ in range(100)} == set(nodes[:2])
+        # An ejected server is skipped right away
+        pools[0]._errors = pools[0]._eject_errors
+        pools[0]._ejected_until = monotonic() + 10
+        assert {pool._keyless_address(nodes) for _ in range(100)} == {nodes[1]}
+    finally:
+        pools[0]._errors = 0
+        for server, latency in zip(pools, latencies):
+            server._latency = latency
+        pool._keyless = None
+
+def test_replica_reads(replica_client):
+    r = replica_client
+    replicas = [address for address, info in r.endpoints() if info["type"] == "replica"]
+    assert len(replicas) == 3
+    with r.connection(key="replica_reads") as c:
+        assert c("set", "replica_reads", "a") == b"OK"
+        assert c("wait", 1, 5000) == 1
+    assert r("get", "replica_reads") == b"a"
+    stats = r.pool_stats()
+    assert any(address in stats for address in replicas)
+    # Writes still go to the master
+    assert r("set", "replica_reads", "b") == b"OK"
+
+
+def test_static_command_table(static_table_client):
+    r = static_table_client
+    pool = r._connection_pool
+    masters = [address for address, info in r.endpoints() if info["type"] == "master"]
+    # WATCH has to go to the master, where the MULTI / EXEC after it runs
+    assert pool._address_by_cmd("watch", "static_table") in masters
+    assert pool._address_by_cmd("set", "static_table", "a") in masters
+    assert pool._address_by_cmd("get", "static_table") not in masters
+    with r.connection(key="static_table") as c:
+        assert c("watch", "static_table") == b"OK"
+        assert c("multi") == b"OK"
+        assert c("set", "static_table", "a") == b"QUEUED"
+        assert c("exec") == [b"OK"]
+    keys = ["static_table%d" % i for i in range(20)]
+    assert r("mset", *[item for key in keys for item in (key, key)]) == b"OK"
+    assert r("del", *keys) == 20
+    # The known commands never need the command table from the server
+    assert not pool._command_table_loaded
@@ -0,0 +1,132 @@
+import pytest
+from justredis.decoder import create_decoder, need_more_data, hiredis, Error, String, Number, Null, Array, Map, Push
+
+
+parsers = ["python", pytest.param("hiredis", marks=pytest.mark.skipif(hiredis is None, reason="hiredis is not installed"))]
+
+
+# Feeds the data at once, or byte by byte, and returns all the replies extracted
+def decode(data, bytewise, **kwargs):
+    decoder = create_decoder(**kwargs)
+    chunks = [data[i : i + 1] for i in range(len(data))] if bytewise else [data]
+    replies = []
+    for chunk in chunks:
+        decoder.feed(chunk)
+        while True:
+            msg = decoder.extract()
+            if msg is need_more_data:
+                break
+            replies.append(msg)
+    return replies
+
+
+resp2_replies = [
+    (b"+OK\r\n", b"OK"),
+    (b":42\r\n", 42),
+    (b":-1\r\n", -1),
+    (b"$5\r\nhello\r\n", b"hello"),
+    (b"$0\r\n\r\n", b""),
+    (b"$-1\r\n", None),
+    (b"*-1\r\n", None),
+    (b"*0\r\n", []),
+    (b"*2\r\n$1\r\na\r\n:1\r\n", [b"a", 1]),
+    (b"*3\r\n*1\r\n:1\r\n*0\r\n$-1\r\n", [[1], [], None]),
+]
+
+
+resp3_replies = [
+    (b"_\r\n", None),
+    (b",1.5\r\n", 1.5),
+    (b"#t\r\n", True),
+    (b"#f\r\n", False),
+    (b"(3492890328409238509324850943850943825024385\r\n", 3492890328409238509324850943850943825024385),
+    (b"=8\r\ntxt:some\r\n", b"txt:some"),
+    (b"%1\r\n+a\r\n:1\r\n", {b"a": 1}),
+    (b"~2\r\n:1\r\n:2\r\n", {1, 2}),
+    (b">2\r\n+message\r\n:1\r\n", [b"message", 1]),
+    (b"|1\r\n+ttl\r\n:3\r\n:5\r\n", 5),
+    (b"*2\r\n|1\r\n+a\r\n:1\r\n:5\r\n:6\r\n", [5, 6]),
+    (b"$?\r\n;4\r\nhell\r\n;1\r\no\r\n;0\r\n", b"hello"),
+    (b"*?\r\n:1\r\n.\r\n", [1]),
+]
+
+
+@pytest.mark.parametrize("bytewise", [False, True])
+@pytest.mark.parametrize("parser", parsers)
+@pytest.mark.parametrize("data, expected", resp2_replies)
+def test_resp2(parser, bytewise, data, expected):
+    assert decode(data, bytewise, parser=parser) == [expected]
+
+
+@pytest.mark.parametrize("bytewise", [False, True])
+@pytest.mark.parametrize("parser", parsers)
+def test_resp2_many(parser, bytewise):
+    data = b"".join(reply[0] for reply in resp2_replies)
+    assert decode(data, bytewise, parser=parser) == [reply[1] for reply in resp2_replies]
+
+
+@pytest.mark.parametrize("bytewise", [False, True])
+@pytest.mark.parametrize("parser", parsers)
+def test_resp2_error(parser, bytewise):
+    replies = decode(b"-ERR bad\r\n:1\r\n", bytewise, parser=parser)
+    assert isinstance(replies[0], Error) and replies[0].args[0] == "ERR bad"
+    assert replies[1] == 1
+
+
+@pytest.mark.parametrize("bytewise", [False, True])
+@pytest.mark.parametrize("parser", parsers)
+def test_resp2_attributes(parser, bytewise):
+    replies = decode(b"*3\r\n$1\r\na\r\n:1\r\n$-1\r\n", bytewise, parser=parser, attributes=True)
+    assert isinstance(replies[0], Array)
+    a, one, none = replies[0].data
+    assert isinstance(a, String) and a.data == b"a"
+    assert isinstance(one, Number) and one.data == 1
+    assert isinstance(none, Null)
+
+
+@pytest.mark.parametrize("bytewise", [False, True])
+@pytest.mark.parametrize("data, expected", resp3_replies)
+def test_resp3(bytewise, data, expected):
+    assert decode(data, bytewise, parser="python", resp_version=3) == [expected]
+
+
+@pytest.mark.parametrize("bytewise", [False, True])
+def test_resp3_many(bytewise):
+    data = b"".join(reply[0] for reply in resp3_replies)
+    assert decode(data, bytewise, parser="python", resp_version=3) == [reply[1] for reply in resp3_replies]
+
+
+@pytest.mark.parametrize("bytewise", [False, True])
+def test_resp3_attribute_type(bytewise):
+    replies = decode(b"|1\r\n+ttl\r\n:3\r\n*2\r\n|1\r\n+a\r\n:1\r\n:5\r\n:6\r\n", bytewise, parser="python", resp_version=3, attributes=True)
+    assert isinstance(replies[0], Array) and replies[0].attr is not None
+    assert {key.data: value.data for key, value in replies[0].attr.items()} == {b"ttl": 3}
+    first, second = replies[0].data
+    assert first.data == 5 and {key.data: value.data for key, value in first.attr.items()} == {b"a": 1}
+    assert second.data == 6 and second.attr is None
+
+
+@pytest.mark.parametrize("bytewise", [False, True])
+def test_resp3_push_type(bytewise):
+    replies = decode(b">3\r\n$7\r\nmessage\r\n$4\r\nchan\r\n%1\r\n+a\r\n:1\r\n:2\r\n", bytewise, parser="python", resp_version=3, attributes=True)
+    assert isinstance(replies[0], Push)
+    kind, channel, data = replies[0].data
+    assert kind.data == b"message" and channel.data == b"chan"
+    assert isinstance(data, Map) and {key.data: value.data for key, value in data.data.items()} == {b"a": 1}
+    assert isinstance(replies[1], Number) and replies[1].data == 2
+
+
+@pytest.mark.parametrize("bytewise", [False, True])
+def test_resp3_error(bytewise):
+    replies = decode(b"!7\r\nERR bad\r\n-ERR other\r\n", bytewise, parser="python", resp_version=3)
+    assert [reply.args[0] for reply in replies] == ["ERR bad", "ERR other"]
+    assert all(isinstance(reply, Error) for reply in replies)
+
+
+def test_hiredis_resp3():
+    if hiredis is None:
+        with pytest.raises(ValueError):
+            create_decoder(parser="hiredis")
+    else:
+        with pytest.raises(ValueError):
+            create_decoder(parser="hiredis", resp_version=3)